@@ -1,4 +1,11 @@
+from multiprocess import freeze_support
+from quantis import import_times
+
+# Must be enabled before the app is imported to see its imports
+import_times.enable()
 from quantis import app
 
 if __name__ == "__main__":
+    # Analyses run in background processes, which frozen executables must support
+    freeze_support()
     app.start_webview()
\ No newline at end of file
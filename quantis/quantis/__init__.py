@@ -1,7 +1,15 @@
-from . import app
-from .app import launch_import as launch
+import importlib
 
 __all__ = [
     "app",
     "launch"
-]
\ No newline at end of file
+]
+
+
+def __getattr__(name):
+    # GUI modules are imported on first use, so headless mode does not load Dash and pywebview
+    if name == "app":
+        return importlib.import_module(".app", __name__)
+    if name == "launch":
+        return importlib.import_module(".app", __name__).launch_import
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
\ No newline at end of file
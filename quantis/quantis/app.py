@@ -5,7 +5,10 @@ SPDX-License-Identifier: Apache-2.0
 """
 
 # from . import log_setup
-from dash import Dash, dcc, callback, Input, Output, State, html, no_update, dash_table, ctx
+from dash import (
+    Dash, dcc, callback, clientside_callback, ClientsideFunction,
+    Input, Output, State, html, no_update, dash_table, ctx, DiskcacheManager
+)
 import dash_bootstrap_components as dbc
 # import dash_uploader as du
 from dash_daq.ColorPicker import ColorPicker
@@ -13,7 +16,10 @@ from pathlib import Path
 import pandas as pd
 import numpy as np
 import atexit
+import shutil
+import os
 import re
+import diskcache
 from traceback import format_exc
 
 import argparse as argp
@@ -24,16 +30,22 @@ import webview
 import webbrowser
 
 from .ncbi_species_parser import fetch_species_name
-from .cash_or_new import hash_parameters, check_existing_data, save_data
-from .string_request import get_string_svg, get_annotations, get_string_ids
+from .cash_or_new import default_cache_dir, evict
+from .string_request import fetch_string_results
 from .open_tsv_files_dialog import open_tsv_files_dialog, save_csv_file_dialog, open_exe_files_dialog
 from .utils import *
 from .ms1diffacto import *
+from .pipeline import PipelineInput, Staged, run_pipeline, classify_stage, select_stage, plot_stage
+from .results import save_result, load_result, query_result
 from .filetypes import descriptions as FTD
+from . import import_times
 
 
 FILES_PATH = Path(__file__).parent / "user_files"
-CACHE_PATH = Path(__file__).parent / "data_cache"
+CACHE_PATH = default_cache_dir()
+# Results are read by the server after background jobs exit, so they are
+# kept in the cache, apart from files removed on exit
+RESULTS_PATH = CACHE_PATH / "results"
 ASSETS_PATH = Path(__file__).parent / "assets"
 
 def resource_path(relative_path):
@@ -52,9 +64,13 @@ def resource_path(relative_path):
 
 def reinstantiate():
     global app, window
+    # Long analyses run in separate processes, so that UI stays responsive and they can be cancelled.
+    # Job store is created on start in the cache folder, the package folder may be read-only
+    background_manager = DiskcacheManager(diskcache.Cache(str(CACHE_PATH / "jobs")))
     app = Dash(
         "Quantis", title="Quantis", assets_folder=str(resource_path("assets")),
-        external_stylesheets=[str(resource_path("assets/css/dragula.css")), dbc.themes.BOOTSTRAP]
+        external_stylesheets=[str(resource_path("assets/css/dragula.css")), dbc.themes.BOOTSTRAP],
+        background_callback_manager=background_manager,
     )
     window = webview.create_window(app.title, app.server, width=1200, height=800)  # type: ignore
 
@@ -82,11 +98,14 @@ def hide_show_divs(value):
     Output("executable_div", "style"),
     Output("diffacto_div", "style"),
     Output("main_header", "children"),
-    Input("input_format", "value")
+    Input("input_format", "value"),
+    Input("dif_engine", "value"),
 )
-def hide_show_diffacto(value):
+def hide_show_diffacto(value, engine):
     if value == "s+d":
-        return {"display": "grid"}, {"display": "grid"}, "ms1todiffacto.py"
+        # Built-in engine needs no executable
+        executable_style = {"display": "none"} if engine == "builtin" else {"display": "grid"}
+        return executable_style, {"display": "grid"}, "ms1todiffacto.py"
     else:
         return {"display": "none"}, {"display": "none"}, "Quantis"
 
@@ -156,6 +175,16 @@ def disable_imputation(value):
         return False, "Min"
 
 
+# Number of neighbours is only used by kNN imputation
+@callback(
+    Output("knn_neighbors", "disabled"),
+    Input("imputation", "value"),
+    Input("imputation", "disabled"),
+)
+def disable_knn_neighbors(value, imputation_disabled):
+    return imputation_disabled or value != "kNN"
+
+
 # Disable bonferonni correction for dynamic threshold calculation
 @callback(
     Output("correction", "options"),
@@ -507,13 +536,14 @@ NULL_PLOT = {"layout": {
 # Start analysis
 @callback(
     Output("volcano_plot", "figure"),
-    Output("result_proteins_table", "data"),
+    Output("run_id", "data"),
     Output("save_proteins_button", "disabled"),
     Output("run_error", "children"),
     Output("run_error", "is_open"),
     Output("fold_change_input_left", "value"),
     Output("fold_change_input_right", "value"),
     Output("pvalue_input", "value"),
+    Output("run_state", "data"),
     Input("start_button", "n_clicks"),
     State("executable_path", "value"),
     State("fold_change_input_left", "value"),
@@ -528,6 +558,7 @@ NULL_PLOT = {"layout": {
     State("col_prefix", "value"),
     State("column_DT", "data"),
     State("imputation", "value"),
+    State("knn_neighbors", "value"),
     State("up_color", "value"),
     State("down_color", "value"),
     State("not_color", "value"),
@@ -535,102 +566,71 @@ NULL_PLOT = {"layout": {
     State("dif_normalize", "value"),
     State("dif_impute_threshold", "value"),
     State("dif_min_samples", "value"),
+    State("dif_engine", "value"),
     # prevent_initial_call=True,
+    # Every job is a new process: stages memoized by an earlier run are not
+    # reused here, reruns rely on the disk cache and stored file digests
+    background=True,
+    running=[
+        (Output("cancel_button", "disabled"), False, True),
+        (Output("run_progress_div", "style"), {"display": "block"}, {"display": "none"}),
+    ],
+    cancel=[Input("cancel_button", "n_clicks")],
+    progress=[Output("run_progress", "value"), Output("run_progress", "label")],
 )
 def run_quantis(
+    set_progress,
     _, exec_str, fc_threshold_l, fc_threshold_r,
     pvalue_threshold, regulation, correction,
     threshold_calculation,
     control_files, test_files, single_file,
     col_prefix, column_DT,
-    imputation,
+    imputation, knn_neighbors,
     up_color, down_color, not_color,
     input_format,
-    d_norm, d_it, d_ms
+    d_norm, d_it, d_ms, d_engine
 ):
     try:
         thhs_set = Thresholds(up_fc=fc_threshold_r, down_fc=fc_threshold_l, p_value=-np.log10(pvalue_threshold))
         color_scheme: ColorScheme = {'UP': up_color['hex'], 'DOWN': down_color['hex'], 'NOT': not_color['hex']}
 
-        if input_format == "s+d":
+        cfl = [f["path"] for f in control_files or []]
+        tfl = [f["path"] for f in test_files or []]
+        K_cols: list[str] = []
+        A_cols: list[str] = []
+        d_params = None
+        if input_format in ("s+d", "Scavager"):
             if not control_files or not test_files:
-                return NULL_PLOT, no_update, no_update, "", False, no_update, no_update, no_update
-            if not exec_str:
-                return NULL_PLOT, no_update, no_update, "No executable file selected", True, no_update, no_update, no_update
-            cfl = [f["path"] for f in control_files]
-            tfl = [f["path"] for f in test_files]
-            _hash = hash_parameters(cfl, tfl, imputation, input_format)
-            data = check_existing_data(_hash, str(CACHE_PATH))
-            d_input = compile_diffacto_data(cfl, tfl, str(FILES_PATH))
-            d_it = d_it or 0.75
-            d_ms = d_ms or 3
-            single_file = run_diffacto(
-                d_input, exec_str,
-                DiffactoParameters(normalize=d_norm, impute_threshold=d_it, min_samples=d_ms),
-                str(FILES_PATH)
-            )
-            input_format = "Diffacto"
-
-        if input_format == "Scavager":
-            if not control_files or not test_files:
-                return NULL_PLOT, no_update, no_update, "", False, no_update, no_update, no_update
-            # Turn files into lists
-            cfl = [f["path"] for f in control_files]
-            tfl = [f["path"] for f in test_files]
-            _hash = hash_parameters(cfl, tfl, imputation, input_format)
-            data = check_existing_data(_hash, str(CACHE_PATH))
-            if data is None:
-                tgdf = load_data_scavager(cfl, tfl)
-                ogdf = OneGroupDF(tgdf.data, tgdf.K_cols + tgdf.A_cols)
-                data = impute_missing_values(ogdf, imputation)
-                tgdf = TwoGroupDF(data, tgdf.K_cols, tgdf.A_cols)
-                data = calculate_fold_change_p_value(tgdf)
-                save_data(data, _hash, str(CACHE_PATH))
-            dwt = DFwThresholds(data, thhs_set)
-            dwt = apply_mtc_and_log(dwt, correction)
-            thhs_calc = calculate_thresholds(dwt.data)
-
-        else:
+                return NULL_PLOT, no_update, no_update, "", False, no_update, no_update, no_update, None
+            if input_format == "s+d":
+                if d_engine != "builtin" and not exec_str:
+                    return NULL_PLOT, no_update, no_update, "No executable file selected", True, no_update, no_update, no_update, None
+                d_it = d_it or 0.75
+                d_ms = d_ms or 3
+                d_params = DiffactoParameters(normalize=d_norm, impute_threshold=d_it, min_samples=d_ms)
+        elif input_format in ("DirectMS1Quant", "Diffacto", "MaxQuant"):
             if not single_file:
-                return NULL_PLOT, no_update, no_update, no_update, no_update, no_update, no_update, no_update
-
-            if input_format == "DirectMS1Quant":
-                data = load_data_directms1quant(single_file)
-                dwt = DFwThresholds(data, thhs_set)
-                dwt = apply_mtc_and_log(dwt, correction)
-                thhs_calc = calculate_thresholds_directms1quant(dwt.data)
-
-            elif input_format == "Diffacto":
-                data = load_data_diffacto(single_file)
-                dwt = DFwThresholds(data, thhs_set)
-                dwt = apply_mtc_and_log(dwt, correction)
-                thhs_calc = calculate_thresholds(dwt.data)
-
-            elif input_format == "MaxQuant":
+                return NULL_PLOT, no_update, no_update, no_update, no_update, no_update, no_update, no_update, None
+            if input_format == "MaxQuant":
                 K_cols = [col_prefix+" "+col["col"] for col in column_DT if col["kan"] == "K"]
                 A_cols = [col_prefix+" "+col["col"] for col in column_DT if col["kan"] == "A"]
-                _hash = hash_parameters(single_file, K_cols+A_cols, "None", input_format)
-                data = check_existing_data(_hash, str(CACHE_PATH))
-                if data is None:
-                    ogdf = load_data_maxquant(single_file, K_cols, A_cols)
-                    data = impute_missing_values(ogdf, imputation)
-                    tgdf = TwoGroupDF(data, K_cols, A_cols)
-                    data = calculate_fold_change_p_value(tgdf)
-                    save_data(data, _hash, str(CACHE_PATH))
-                dwt = DFwThresholds(data, thhs_set)
-                dwt = apply_mtc_and_log(dwt, correction)
-                thhs_calc = calculate_thresholds(dwt.data)
-
-            else:
-                return NULL_PLOT, no_update, no_update, "", False, no_update, no_update, no_update
-
-        if correction == "bonferroni":
-            thhs = dwt.thresholds
         else:
-            thhs = replace_thresholds(thhs_set, thhs_calc, threshold_calculation)
-        dwt = DFwThresholds(dwt.data, thhs)
-        dwt, data_de = apply_thresholds(dwt, regulation)
-        if input_format in ("DirectMS1Quant", "Diffacto") or threshold_calculation != "static":
+            return NULL_PLOT, no_update, no_update, "", False, no_update, no_update, no_update, None
+
+        pi = PipelineInput(
+            input_format, cfl, tfl, single_file, K_cols, A_cols, imputation,
+            diffacto_path=exec_str, diffacto_parameters=d_params,
+            n_neighbors=int(knn_neighbors or 5), quant_engine=d_engine or "diffacto"
+        )
+        dwt, data_de, figure, run_id, corrected_id = run_pipeline(
+            pi, thhs_set, correction, threshold_calculation, regulation, color_scheme,
+            str(CACHE_PATH), str(FILES_PATH),
+            progress=lambda fraction, message: set_progress((round(100 * fraction), message))
+        )
+        save_result(run_id, data_de, str(RESULTS_PATH))
+        # Slider changes classify this table again, see refresh_de_table
+        save_result(corrected_id, dwt.data, str(RESULTS_PATH))
+        if input_format in ("DirectMS1Quant", "Diffacto", "s+d") or threshold_calculation != "static":
             fctr = round(dwt.thresholds.up_fc, 2)
             fctl = round(dwt.thresholds.down_fc, 2)
             pt = round(0.1**dwt.thresholds.p_value, 3)
@@ -638,47 +638,195 @@ def run_quantis(
             fctr = no_update
             fctl = no_update
             pt = no_update
-        return build_volcano_plot(dwt, color_scheme), data_de.to_dict("records"), False, "", False, fctl, fctr, pt
+        # Inputs written here come back through the sliders rounded,
+        # see fc_sync and pvalue_sync
+        sliders = {
+            "fc": [fc_threshold_l if fctl is no_update else fctl, fc_threshold_r if fctr is no_update else fctr],
+            "p": round(float(np.log10(pvalue_threshold if pt is no_update else pt)), 2),
+        }
+        run_state = {
+            "corrected_id": corrected_id,
+            "correction": correction,
+            "threshold_calculation": threshold_calculation,
+            "regulation": regulation,
+            "thresholds": {k: float(v) for k, v in dwt.thresholds._asdict().items()},
+            # Slider values standing for the thresholds above
+            "sliders": sliders,
+            # Bonferroni shifts p-value threshold by log10 of number of proteins
+            "p_offset": float(dwt.thresholds.p_value - thhs_set.p_value) if threshold_calculation == "static" else 0.0,
+            "fixed_fc": threshold_calculation in ("dynamic", "ms1"),
+            "fixed_p": threshold_calculation != "static",
+            "colors": color_scheme,
+        }
+        return figure, run_id, False, "", False, fctl, fctr, pt, run_state
     except Exception as e:
-        return NULL_PLOT, [], True, [
+        return NULL_PLOT, None, True, [
             html.H2("An error has occured!"),
             # *[html.P(line, style={"padding": "0"}) for line in format_exc(limit=3).split("\n")]
             html.Code(format_exc(limit=3), style={"white-space": "pre-wrap"})
-        ], True, no_update, no_update, no_update
+        ], True, no_update, no_update, no_update, None
+
+# Move threshold lines and recolour points in the browser while sliders move
+clientside_callback(
+    ClientsideFunction(namespace="volcano", function_name="recolour"),
+    Output("volcano_plot", "figure", allow_duplicate=True),
+    Input("fold_change_slider", "value"),
+    Input("fold_change_slider", "drag_value"),
+    Input("pvalue_slider", "value"),
+    Input("pvalue_slider", "drag_value"),
+    State("volcano_plot", "figure"),
+    State("run_state", "data"),
+    prevent_initial_call=True
+)
+
+# Refresh DE proteins when a slider is released
+@callback(
+    Output("run_id", "data", allow_duplicate=True),
+    Output("run_state", "data", allow_duplicate=True),
+    Output("volcano_plot", "figure", allow_duplicate=True),
+    Input("fold_change_slider", "value"),
+    Input("pvalue_slider", "value"),
+    State("run_state", "data"),
+    prevent_initial_call=True
+)
+def refresh_de_table(fc_value, pvalue_value, run_state):
+    if not run_state or run_state["fixed_fc"] and run_state["fixed_p"]:
+        return no_update, no_update, no_update
+    thresholds = run_state["thresholds"]
+    sliders = run_state["sliders"]
+    up_fc, down_fc, p_value = thresholds["up_fc"], thresholds["down_fc"], thresholds["p_value"]
+    # Sliders still at the values of current thresholds (e.g. rounded
+    # thresholds written back by the run) keep them unrounded
+    if not run_state["fixed_fc"] and not np.allclose(fc_value, sliders["fc"]):
+        down_fc, up_fc = fc_value
+    if not run_state["fixed_p"] and not np.isclose(pvalue_value, sliders["p"]):
+        p_value = -pvalue_value + run_state["p_offset"]
+    if np.allclose([up_fc, down_fc, p_value], [thresholds["up_fc"], thresholds["down_fc"], thresholds["p_value"]]):
+        return no_update, no_update, no_update
+    # Corrected data of the run is classified again, input files are not read
+    corrected_id = run_state["corrected_id"]
+    try:
+        corrected = Staged(corrected_id, load_result(corrected_id, str(RESULTS_PATH)))
+    except KeyError:  # Evicted from the cache, results stay as they are
+        return no_update, no_update, no_update
+    thresholds = Thresholds(up_fc, down_fc, p_value)
+    classified = classify_stage(corrected, thresholds)
+    selected = select_stage(classified, run_state["regulation"])
+    save_result(selected.key, selected.value, str(RESULTS_PATH))
+    run_state["thresholds"] = {k: float(v) for k, v in thresholds._asdict().items()}
+    run_state["sliders"] = {"fc": fc_value, "p": pvalue_value}
+    # Thinned plots lack NOT points that new thresholds may turn UP or DOWN,
+    # so those are built again; the browser recolours the rest while dragging
+    figure = no_update
+    if len(corrected.value) > HIGH_VOLUME_POINTS:
+        figure = plot_stage(classified, run_state["colors"]).value
+    return selected.key, run_state, figure
+
+RESULT_COLUMNS = [
+    {"name": "Protein", "id": "dbname"},
+    {"name": "Fold Change", "id": "FC", "type": "numeric"},
+    {"name": "p-value", "id": "logFDR", "type": "numeric"},
+]
+
+# Send the requested page of DE proteins
+@callback(
+    Output("result_proteins_table", "data"),
+    Output("result_proteins_table", "page_count"),
+    Output("result_proteins_table", "page_current"),
+    Output("filter_error", "children"),
+    Output("filter_error", "is_open"),
+    Input("run_id", "data"),
+    Input("result_proteins_table", "page_current"),
+    Input("result_proteins_table", "page_size"),
+    Input("result_proteins_table", "sort_by"),
+    Input("result_proteins_table", "filter_query"),
+)
+def show_de_page(run_id, page_current, page_size, sort_by, filter_query):
+    if not run_id:
+        return [], 1, 0, "", False
+    # New results and new filters start from the first page
+    if "result_proteins_table.page_current" not in ctx.triggered_prop_ids:
+        page_current = 0
+    try:
+        data, page_count = query_result(
+            run_id, str(RESULTS_PATH), page_current or 0, page_size, sort_by, filter_query or "",
+            [column["id"] for column in RESULT_COLUMNS]
+        )
+    except ValueError as e:
+        # Show no rows rather than unfiltered ones
+        return [], 1, 0, str(e), True
+    except KeyError as e:
+        # Stored results were evicted from the cache
+        return [], 1, 0, f"{e.args[0]}, run the analysis again", True
+    return data, page_count, page_current, "", False
+
+def string_results(run_id, inpf: str, rs, sp, csp):
+    """Start STRING requests for DE proteins of a run. None if there are no DE proteins."""
+    if sp == -1:
+        sp = csp
+    data = load_result(run_id, str(RESULTS_PATH))
+    if data.empty:
+        return None
+    if inpf == "MaxQuant":
+        import re
+        template = re.compile(r"sp\|([A-Z0-9]+)")
+        proteins = [re.findall(template, dbname)[0] for dbname in data["dbname"]]
+    else:
+        proteins = [dbname.split("|")[1] for dbname in data["dbname"]]
+    rs = rs or None
+    # Network and annotations are fetched concurrently and shared by both callbacks
+    return fetch_string_results(proteins, sp, rs)
 
 # Show StringDB network
 @callback(
     Output("string_svg", "src"),
-    Output("annotations_table", "data"),
     Output("run_error", "children", allow_duplicate=True),
     Output("run_error", "is_open", allow_duplicate=True),
-    Input("result_proteins_table", "data"),
+    Input("run_id", "data"),
     State("input_format", "value"),
     State("req_score", "value"),
     State("species", "value"),
     State("custom_species", "value"),
     prevent_initial_call=True
 )
-def show_string_network(data, inpf: str, rs, sp, csp):
+def show_string_network(run_id, inpf: str, rs, sp, csp):
     try:
-        if sp == -1:
-            sp = csp
-        if not data:
+        if not run_id:
             return no_update
-        if inpf == "MaxQuant":
-            import re
-            template = re.compile(r"sp\|([A-Z0-9]+)")
-            proteins = [re.findall(template, row["dbname"])[0] for row in data]
-        else:
-            proteins = [row["dbname"].split("|")[1] for row in data]
-        rs = rs or None
-        ids = get_string_ids(proteins, sp)
-        svg = get_string_svg(ids, sp, rs)
-        annots = get_annotations(ids, sp)
-        d_a = annots.to_dict("records")
-        return svg, d_a, no_update, False
+        results = string_results(run_id, inpf, rs, sp, csp)
+        if results is None:
+            return no_update
+        return results.svg.result(), no_update, False
+    except Exception as e:
+        return no_update, [
+            html.H2("An error has occured!"),
+            html.Code(format_exc(limit=3), style={"white-space": "pre-wrap"})
+        ], True
+
+# Show GO annotations as soon as they arrive, without waiting for the network.
+# Errors go to their own alert: duplicate outputs of callbacks with the same
+# inputs would get the same ID and break the callback graph
+@callback(
+    Output("annotations_table", "data"),
+    Output("annotations_error", "children"),
+    Output("annotations_error", "is_open"),
+    Input("run_id", "data"),
+    State("input_format", "value"),
+    State("req_score", "value"),
+    State("species", "value"),
+    State("custom_species", "value"),
+    prevent_initial_call=True
+)
+def show_annotations(run_id, inpf: str, rs, sp, csp):
+    try:
+        if not run_id:
+            return no_update
+        results = string_results(run_id, inpf, rs, sp, csp)
+        if results is None:
+            return no_update
+        return results.annotations.result().to_dict("records"), no_update, False
     except Exception as e:
-        return no_update, no_update, [
+        return no_update, [
             html.H2("An error has occured!"),
             html.Code(format_exc(limit=3), style={"white-space": "pre-wrap"})
         ], True
@@ -688,11 +836,16 @@ def show_string_network(data, inpf: str, rs, sp, csp):
 @callback(
     Output("download_proteins", "data"),
     Input("save_proteins_button", "n_clicks"),
-    State("result_proteins_table", "data"),
+    State("run_id", "data"),
     prevent_initial_call=True
 )
-def save_proteins(_, data):
-    df = pd.DataFrame(data)
+def save_proteins(_, run_id):
+    if not run_id:
+        return None
+    try:
+        df = load_result(run_id, str(RESULTS_PATH))
+    except KeyError:
+        return None
     path = save_csv_file_dialog(window)
     if path:
         df.to_csv(str(path), index=False)
@@ -702,50 +855,84 @@ def save_proteins(_, data):
 @callback(
     Output("result_proteins_table", "active_cell"),
     Input("result_proteins_table", "active_cell"),
-    State("result_proteins_table", "data"),
+    State("run_id", "data"),
     prevent_initial_call=True
 )
-def open_uniprot_browser(active_cell, data):
-    if active_cell is None:
+def open_uniprot_browser(active_cell, run_id):
+    if active_cell is None or not run_id:
+        return no_update
+    # Row ID is the position of the row in stored results
+    try:
+        dbname = load_result(run_id, str(RESULTS_PATH))["dbname"].iloc[active_cell["row_id"]]
+    except KeyError:
         return no_update
-    dbname = data[active_cell["row"]]["dbname"]
     uniprot_id = re.findall(r"sp\|([A-Z0-9]+)", dbname)[0]
     if uniprot_id:
         webbrowser.open(f"https://www.uniprot.org/uniprot/{uniprot_id}")
     return None
 
+def point_protein(point: dict, run_state: dict | None) -> str | None:
+    """Protein of a volcano plot point. Points carry row numbers of corrected data of the run."""
+    if not run_state or "customdata" not in point:
+        return None
+    try:
+        data = load_result(run_state["corrected_id"], str(RESULTS_PATH))
+    except KeyError:
+        return None
+    return data["dbname"].iloc[int(point["customdata"])]
+
 # On DE proteins graph click, open Uniprot in browser with protein ID
 @callback(
     Input("volcano_plot", "clickData"),
+    State("run_state", "data"),
     prevent_initial_call=True
 )
-def open_uniprot_browser_graph(data):
-    if not data:
+def open_uniprot_browser_graph(data, run_state):
+    if not data or not data["points"]:
         return no_update
-    points = data["points"]
-    if not points:
+    dbname = point_protein(data["points"][0], run_state)
+    if dbname is None:
         return no_update
-    point = points[0]
-    dbname = point["customdata"][0]
     uniprot_id = re.findall(r"sp\|([A-Z0-9]+)", dbname)[0]
     if uniprot_id:
         webbrowser.open(f"https://www.uniprot.org/uniprot/{uniprot_id}")
     return None
 
-# On scipt exit remove uploaded files
+# Show name of the protein under cursor, names are not sent with the plot
+@callback(
+    Output("hovered_protein", "children"),
+    Input("volcano_plot", "hoverData"),
+    State("run_state", "data"),
+    prevent_initial_call=True
+)
+def show_hovered_protein(data, run_state):
+    if not data or not data["points"]:
+        return ""
+    return point_protein(data["points"][0], run_state) or ""
+
+# On scipt exit remove uploaded files. Data cache is kept between sessions
 def remove_files():
+    if not FILES_PATH.exists():
+        return
     for file in FILES_PATH.iterdir():
-        file.unlink()
-    for file in CACHE_PATH.iterdir():
-        file.unlink()
+        if file.is_dir():
+            shutil.rmtree(file)
+        else:
+            file.unlink()
 
 def create_user_files_dirs():
+    """Prepare folders of the launching process and remove its files on exit.
+
+    Only called by the process that starts the app: background jobs import
+    this module in new processes, and their exit must not remove files of
+    the session or of other running jobs.
+    """
     if not FILES_PATH.exists():
         FILES_PATH.mkdir()
     if not CACHE_PATH.exists():
-        CACHE_PATH.mkdir()
-
-atexit.register(remove_files)
+        CACHE_PATH.mkdir(parents=True)
+    evict(str(CACHE_PATH))
+    atexit.register(remove_files)
 
 
 def set_layout(app: Dash, args: argp.Namespace):
@@ -873,13 +1060,15 @@ def set_layout(app: Dash, args: argp.Namespace):
                 html.Table([
                     # First row
                     html.Tr([
-                        html.Td("Imputation", style={"width": "25%"}),
-                        html.Td("Regulation", style={"width": "25%"}),
-                        html.Td("Threshold calculation", style={"width": "25%"}),
-                        html.Td("Multiple-testing correction", style={"width": "25%"}),
+                        html.Td("Imputation", style={"width": "20%"}),
+                        html.Td("kNN neighbours", style={"width": "12%"}),
+                        html.Td("Regulation", style={"width": "20%"}),
+                        html.Td("Threshold calculation", style={"width": "24%"}),
+                        html.Td("Multiple-testing correction", style={"width": "24%"}),
                     ]),
                     html.Tr([
                         html.Td(dcc.Dropdown(id="imputation", options=["Drop", "Min", "kNN"], value="Min", clearable=False)),  # default: Min
+                        html.Td(dcc.Input(id="knn_neighbors", type="number", min=1, max=50, step=1, value=5, disabled=True, style={"width": "100%"})),
                         html.Td(dcc.Dropdown(id="regulation", options=["UP", "DOWN", "BOTH"], value="BOTH", clearable=False)),  # default: BOTH
                         html.Td(dcc.Dropdown(id="threshold_calculation", options=[
                             {"label": "static", "value": "static"},
@@ -918,11 +1107,16 @@ def set_layout(app: Dash, args: argp.Namespace):
                         html.Td("Normalize"),
                         html.Td("Impute threshold"),
                         html.Td("Min samples"),
+                        html.Td("Engine"),
                     ]),
                     html.Tr([
                         html.Td(dcc.Dropdown(id="dif_normalize", options=['average','median','GMM','None'], value="None", clearable=False)),
                         html.Td(dcc.Input(id="dif_impute_threshold", type="number", min=0, max=1, step=0.05, value=0)),
                         html.Td(dcc.Input(id="dif_min_samples", type="number", min=0, max=20, step=1, value=0)),
+                        html.Td(dcc.Dropdown(
+                            id="dif_engine", clearable=False, value="diffacto",
+                            options=[{"label": "Diffacto", "value": "diffacto"}, {"label": "Built-in", "value": "builtin"}],
+                        )),
                     ]),
                 ], style={"padding": 10, 'width': '100%'}),
             ], style={'display': 'hidden'}, id="diffacto_div"),
@@ -963,19 +1157,28 @@ def set_layout(app: Dash, args: argp.Namespace):
                 "Start Analysis", id="start_button", className="start_button",
                 style={'margin-left': 'auto', 'margin-right': 'auto'}
             ),
+            # Progress of a running analysis
+            html.Div([
+                dbc.Progress(id="run_progress", value=0, label="", striped=True, animated=True),
+                html.Button("Cancel", id="cancel_button", className="rm_button", disabled=True),
+            ], style={"display": "none"}, id="run_progress_div"),
             html.Hr(),
         ], className="container"),
         html.Div([
             # ====== Results ======
             # Error div
             dbc.Alert(id="run_error",color="danger", is_open=False, style={'user-select': 'all'}),
+            dcc.Store(id="run_state"),
+            dcc.Store(id="run_id"),
             dcc.Loading(dcc.Graph(id="volcano_plot"), type="graph"),
+            html.P(id="hovered_protein", style={"text-align": "center", "min-height": "1.5em"}),
             dcc.Loading([
                 html.Img(
                     id="string_svg",
                     style={"display": "block", "margin-left": "auto", "margin-right": "auto", 'max-width': '100%'}
                 ),
                 html.H3("Enriched GO annotations"),
+                dbc.Alert(id="annotations_error", color="danger", is_open=False, style={'user-select': 'all'}),
                 dash_table.DataTable(
                     id="annotations_table",
                     columns=[
@@ -995,13 +1198,19 @@ def set_layout(app: Dash, args: argp.Namespace):
             html.H3("Differentially Expressed Proteins"),
             html.Button("Save DE protens", id="save_proteins_button", disabled=True),
             dcc.Download(id="download_proteins"),
+            dbc.Alert(id="filter_error", color="warning", is_open=False),
             dash_table.DataTable(
                 id="result_proteins_table",
-                columns=[
-                    {"name": "Protein", "id": "dbname"},
-                    {"name": "Fold Change", "id": "FC"},
-                    {"name": "p-value", "id": "logFDR"},
-                ],
+                columns=RESULT_COLUMNS,
+                # Results are kept on the server, only the shown page is sent
+                page_action="custom",
+                page_current=0,
+                page_size=50,
+                sort_action="custom",
+                sort_mode="multi",
+                sort_by=[],
+                filter_action="custom",
+                filter_query="",
                 style_header={
                     'backgroundColor': 'white',
                     'fontWeight': 'bold',
@@ -1035,10 +1244,12 @@ def set_layout(app: Dash, args: argp.Namespace):
 
 def start_webview():
     create_user_files_dirs()
+    import_times.report()
     webview.start()
 
 
 def launch_from_cli():
+    global CACHE_PATH, RESULTS_PATH
     parser = argp.ArgumentParser(
         description="Visual Interface for qunatification analysis of MS/MS proteomics data",
         formatter_class=argp.ArgumentDefaultsHelpFormatter
@@ -1048,10 +1259,21 @@ def launch_from_cli():
     parser.add_argument("-s1", help="control files input", nargs='+')
     parser.add_argument("-s2", help="test files input", nargs='+')
     parser.add_argument("--web", help="launch as browser app", action="store_true")
+    parser.add_argument("--cache-dir", help="directory for persistent data cache", default=str(CACHE_PATH))
+    parser.add_argument("--import-times", help="print import time of packages on startup", action="store_true")
+    parser.add_argument("--offline", help="use only cached STRING responses", action="store_true")
     args = parser.parse_args()
+    CACHE_PATH = Path(args.cache_dir)
+    RESULTS_PATH = CACHE_PATH / "results"
+    # Analyses run in background processes, which read cache location from environment
+    os.environ["QUANTIS_CACHE_DIR"] = args.cache_dir
+    if args.offline:
+        os.environ["QUANTIS_OFFLINE"] = "1"
     reinstantiate()
     set_layout(app, args)
     if args.web:
+        create_user_files_dirs()
+        import_times.report()
         app.run(debug=True)
     else:
         start_webview()
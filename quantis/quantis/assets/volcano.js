@@ -0,0 +1,103 @@
+// Recolour volcano plot points in the browser when thresholds move.
+// Points are regrouped between UP, DOWN and NOT traces and threshold lines
+// are moved, so the figure is not requested from the server again.
+
+const DTYPES = {
+    f4: Float32Array, f8: Float64Array,
+    i1: Int8Array, u1: Uint8Array,
+    i2: Int16Array, u2: Uint16Array,
+    i4: Int32Array, u4: Uint32Array,
+};
+
+// Plotly sends numeric arrays as {dtype, bdata} base64 objects
+function decodeArray(value) {
+    if (!value || Array.isArray(value) || ArrayBuffer.isView(value)) {
+        return value || [];
+    }
+    const bytes = Uint8Array.from(atob(value.bdata), c => c.charCodeAt(0));
+    return Array.from(new DTYPES[value.dtype](bytes.buffer));
+}
+
+function currentThresholds(run, fcValue, fcDrag, pValue, pDrag) {
+    const triggered = (dash_clientside.callback_context.triggered || []).map(t => t.prop_id);
+    const fc = triggered.includes("fold_change_slider.drag_value") ? fcDrag : fcValue;
+    const p = triggered.includes("pvalue_slider.drag_value") ? pDrag : pValue;
+    const thresholds = Object.assign({}, run.thresholds);
+    // Sliders at the values of current thresholds keep them unrounded
+    const close = (a, b) => Math.abs(a - b) < 1e-8;
+    if (!run.fixed_fc && fc && !(close(fc[0], run.sliders.fc[0]) && close(fc[1], run.sliders.fc[1]))) {
+        thresholds.down_fc = fc[0];
+        thresholds.up_fc = fc[1];
+    }
+    if (!run.fixed_p && p !== null && p !== undefined && !close(p, run.sliders.p)) {
+        thresholds.p_value = -p + run.p_offset;
+    }
+    return thresholds;
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    volcano: {
+        recolour: function (fcValue, fcDrag, pValue, pDrag, figure, run) {
+            if (!figure || !figure.data || !run) {
+                return dash_clientside.no_update;
+            }
+            const th = currentThresholds(run, fcValue, fcDrag, pValue, pDrag);
+            const labels = ["UP", "DOWN", "NOT"];
+            const groups = {};
+            labels.forEach(label => { groups[label] = {x: [], y: [], customdata: []}; });
+
+            const templates = {};
+            figure.data.forEach(trace => {
+                if (!labels.includes(trace.name)) {
+                    return;
+                }
+                templates[trace.name] = trace;
+                const x = decodeArray(trace.x);
+                const y = decodeArray(trace.y);
+                // Row numbers of points in the results table
+                const customdata = decodeArray(trace.customdata);
+                for (let i = 0; i < x.length; i++) {
+                    let label = "NOT";
+                    if (y[i] > th.p_value && x[i] > th.up_fc) {
+                        label = "UP";
+                    } else if (y[i] > th.p_value && x[i] < th.down_fc) {
+                        label = "DOWN";
+                    }
+                    groups[label].x.push(x[i]);
+                    groups[label].y.push(y[i]);
+                    groups[label].customdata.push(customdata[i]);
+                }
+            });
+            const base = Object.values(templates)[0];
+            if (!base) {
+                return dash_clientside.no_update;
+            }
+
+            const data = labels.map(label => {
+                let trace = templates[label];
+                if (!trace) {
+                    // Category had no points when the plot was built
+                    trace = Object.assign({}, base, {
+                        name: label,
+                        legendgroup: label,
+                        marker: Object.assign({}, base.marker, {color: run.colors[label]}),
+                        hovertemplate: base.hovertemplate.replace(`Regulation=${base.name}`, `Regulation=${label}`),
+                    });
+                }
+                return Object.assign({}, trace, groups[label]);
+            });
+            const shapes = (figure.layout.shapes || []).map((shape, i) => {
+                // Lines are added in order: p-value, up FC, down FC
+                const value = [th.p_value, th.up_fc, th.down_fc][i];
+                if (value === undefined) {
+                    return shape;
+                }
+                return i === 0 ? Object.assign({}, shape, {y0: value, y1: value}) : Object.assign({}, shape, {x0: value, x1: value});
+            });
+            return Object.assign({}, figure, {
+                data: data,
+                layout: Object.assign({}, figure.layout, {shapes: shapes}),
+            });
+        }
+    }
+});
@@ -0,0 +1,163 @@
+"""Headless batch mode: run comparisons without the GUI
+
+Takes the same options as the GUI, or a manifest with many comparisons,
+runs them in a process pool and writes DE tables and volcano plots to disk.
+Neither Dash nor pywebview is imported.
+
+Manifest is a JSON list of objects. Keys are long option names with
+dashes replaced by underscores (e.g. "s1", "fc_right", "dif_normalize").
+Options given on the command line are used as defaults for every entry.
+
+Copyright 2024 Daniil Pomogaev
+SPDX-License-Identifier: Apache-2.0
+"""
+
+import argparse as argp
+import json
+import os
+import sys
+import tempfile
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from traceback import format_exc
+from typing import Any
+
+import numpy as np
+
+from .cash_or_new import default_cache_dir
+from .ms1diffacto import DiffactoParameters
+from .pipeline import PipelineInput, run_pipeline
+from .utils import Thresholds, ColorScheme
+
+FORMATS = ["Scavager", "s+d", "MaxQuant", "DirectMS1Quant", "Diffacto"]
+
+
+def build_parser() -> argp.ArgumentParser:
+    parser = argp.ArgumentParser(
+        prog="quantis run",
+        description="Run quantification analysis without GUI",
+        formatter_class=argp.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--format", "-f", help="format of input data", choices=FORMATS, default="Scavager")
+    parser.add_argument("--sample", "-s", help="single file input")
+    parser.add_argument("-s1", help="control files input", nargs='+')
+    parser.add_argument("-s2", help="test files input", nargs='+')
+    parser.add_argument("--k-cols", help="MaxQuant control columns", nargs='+')
+    parser.add_argument("--a-cols", help="MaxQuant test columns", nargs='+')
+    parser.add_argument("--manifest", "-m", help="JSON file with a list of comparisons")
+    parser.add_argument("--name", "-n", help="name of comparison, used as output file prefix", default="quantis")
+    parser.add_argument("--output", "-o", help="output directory", default=".")
+    parser.add_argument("--jobs", "-j", help="number of comparisons run in parallel", type=int, default=1)
+    parser.add_argument("--cache-dir", help="directory for persistent data cache", default=str(default_cache_dir()))
+    parser.add_argument("--fc-left", help="log2(FC) threshold for down-regulated proteins", type=float, default=-1)
+    parser.add_argument("--fc-right", help="log2(FC) threshold for up-regulated proteins", type=float, default=1)
+    parser.add_argument("--pvalue", help="p-value threshold", type=float, default=0.01)
+    parser.add_argument("--regulation", choices=["UP", "DOWN", "BOTH"], default="BOTH")
+    parser.add_argument("--correction", choices=["bonferroni", "holm", "fdr_bh", "sh", "none"], default="fdr_bh")
+    parser.add_argument("--threshold-calculation", choices=["static", "semi-dynamic", "dynamic", "ms1"], default="static")
+    parser.add_argument("--imputation", choices=["Drop", "Min", "kNN"], default="Min")
+    parser.add_argument("--knn-neighbors", help="number of neighbours for kNN imputation", type=int, default=5)
+    parser.add_argument("--diffacto", help="path to Diffacto executable")
+    parser.add_argument(
+        "--engine", choices=["diffacto", "builtin"], default="diffacto",
+        help="protein quantification for s+d: Diffacto executable or built-in, in-process rollup"
+    )
+    parser.add_argument("--dif-normalize", choices=['average', 'median', 'GMM', 'None'], default="None")
+    parser.add_argument("--dif-impute-threshold", type=float, default=0.75)
+    parser.add_argument("--dif-min-samples", type=int, default=3)
+    parser.add_argument("--up-color", default="#890c0c")
+    parser.add_argument("--down-color", default="#42640a")
+    parser.add_argument("--not-color", default="#129dfc")
+    parser.add_argument("--figure-format", help="volcano plot format, png and svg require kaleido", default="html")
+    return parser
+
+
+def run_comparison(options: dict[str, Any]) -> list[str]:
+    """Run single comparison. Returns paths of written files."""
+    fmt = options["format"]
+    if fmt == "DirectMS1Quant" and options["threshold_calculation"] == "static":
+        options = {**options, "threshold_calculation": "ms1"}
+    d_params = None
+    if fmt == "s+d":
+        if options["engine"] == "diffacto" and not options["diffacto"]:
+            raise ValueError("Diffacto executable is required for s+d format, unless `--engine builtin` is used")
+        d_params = DiffactoParameters(
+            normalize=options["dif_normalize"],
+            impute_threshold=options["dif_impute_threshold"],
+            min_samples=options["dif_min_samples"],
+        )
+    pi = PipelineInput(
+        fmt, options["s1"] or [], options["s2"] or [], options["sample"] or "",
+        options["k_cols"] or [], options["a_cols"] or [], options["imputation"],
+        diffacto_path=options["diffacto"] or "", diffacto_parameters=d_params,
+        n_neighbors=options["knn_neighbors"], quant_engine=options["engine"]
+    )
+    thresholds = Thresholds(up_fc=options["fc_right"], down_fc=options["fc_left"], p_value=-np.log10(options["pvalue"]))
+    color_scheme: ColorScheme = {'UP': options["up_color"], 'DOWN': options["down_color"], 'NOT': options["not_color"]}
+
+    # File digests and other caches not given a folder read it from environment
+    os.environ["QUANTIS_CACHE_DIR"] = options["cache_dir"]
+    out_dir = Path(options["output"])
+    out_dir.mkdir(parents=True, exist_ok=True)
+    files_path = tempfile.mkdtemp(prefix="quantis_")
+    try:
+        result = run_pipeline(
+            pi, thresholds, options["correction"], options["threshold_calculation"],
+            options["regulation"], color_scheme, options["cache_dir"], files_path
+        )
+    finally:
+        shutil.rmtree(files_path, ignore_errors=True)
+
+    table_file = out_dir / f"{options['name']}_de.tsv"
+    result.data_de.to_csv(table_file, sep="\t", index=False)
+    figure_file = out_dir / f"{options['name']}_volcano.{options['figure_format']}"
+    if options["figure_format"] == "html":
+        result.figure.write_html(figure_file)
+    else:
+        result.figure.write_image(figure_file)
+    return [str(table_file), str(figure_file)]
+
+
+def load_manifest(path: str, defaults: dict[str, Any]) -> list[dict[str, Any]]:
+    """Read comparisons from manifest, filling missing options with defaults."""
+    with open(path) as f:
+        entries = json.load(f)
+    comparisons = []
+    for i, entry in enumerate(entries, start=1):
+        unknown = set(entry) - set(defaults)
+        if unknown:
+            raise ValueError(f"Unknown options in manifest entry {i}: {', '.join(sorted(unknown))}")
+        options = {**defaults, **entry}
+        if "name" not in entry:
+            options["name"] = f"{defaults['name']}_{i}"
+        comparisons.append(options)
+    return comparisons
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+    defaults = vars(args).copy()
+    del defaults["manifest"], defaults["jobs"]
+    if args.manifest:
+        comparisons = load_manifest(args.manifest, defaults)
+    else:
+        comparisons = [defaults]
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        futures = {pool.submit(run_comparison, options): options["name"] for options in comparisons}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                files = future.result()
+            except Exception:
+                failed += 1
+                print(f"[{name}] failed:\n{format_exc(limit=3)}", file=sys.stderr)
+                continue
+            print(f"[{name}] written: {', '.join(files)}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
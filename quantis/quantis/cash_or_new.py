@@ -1,25 +1,260 @@
 """Functions to retrieve the existing data for given input parameters if avaliable,
 otherwise signal to fetch new data.
 
+Cached tables are stored in a binary columnar format, so dtypes survive
+and nothing is re-parsed on a cache hit: Feather (memory-mapped) when
+pyarrow is installed, pickle otherwise.
+
+The cache persists between sessions. Its size is bounded: every cache
+folder keeps an `index.json` with file sizes and access times, and the
+least recently used files are evicted once the folder exceeds the budget
+or a file was not used for too long. Index updates hold a lock file, as
+background jobs of the app and batch workers share the cache.
+
 Copyright 2024 Daniil Pomogaev
 SPDX-License-Identifier: Apache-2.0
 """
 
 import os
+import sys
+import json
+import time
+import shutil
 import hashlib
+import threading
 import pandas as pd
 from pathlib import Path
+from functools import lru_cache
+from contextlib import contextmanager
+from typing import Iterator
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    import msvcrt
+    fcntl = None
+
+try:
+    from pyarrow import feather
+except ImportError:
+    feather = None
+
+CACHE_SUFFIX = ".feather" if feather is not None else ".pkl"
+INDEX_FILE = "index.json"
+# Content digests of input files, kept in the default cache folder
+DIGEST_FILE = "digests.json"
+DIGEST_MAX_ENTRIES = 4096
+LOCK_SUFFIX = ".lock"
+
+# Cache limits, can be overridden with QUANTIS_CACHE_SIZE (MB) and QUANTIS_CACHE_AGE (days)
+CACHE_MAX_BYTES = int(float(os.environ.get("QUANTIS_CACHE_SIZE", 2048)) * 2**20)
+CACHE_MAX_AGE = float(os.environ.get("QUANTIS_CACHE_AGE", 30)) * 24 * 3600
+
+_index_lock = threading.Lock()
+_digest_lock = threading.Lock()
+
+
+def default_cache_dir() -> Path:
+    """Persistent cache location.
+
+    QUANTIS_CACHE_DIR if set, otherwise the user cache directory of the platform.
+    """
+    if "QUANTIS_CACHE_DIR" in os.environ:
+        return Path(os.environ["QUANTIS_CACHE_DIR"])
+    if sys.platform == "win32":
+        base = Path(os.environ.get("LOCALAPPDATA", Path.home() / "AppData" / "Local"))
+        return base / "Quantis" / "Cache"
+    if sys.platform == "darwin":
+        return Path.home() / "Library" / "Caches" / "Quantis"
+    return Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "quantis"
+
+
+@contextmanager
+def _file_lock(path: Path, lock: threading.Lock) -> Iterator[None]:
+    """Hold `lock` of this process and an exclusive lock of `path` + LOCK_SUFFIX,
+    shared with other processes. Lock files are left in place.
+
+    If the lock file cannot be created (e.g. read-only cache), only `lock` is held.
+    """
+    with lock:
+        try:
+            f = open(path.with_name(path.name + LOCK_SUFFIX), "a+b")
+        except OSError:
+            yield
+            return
+        with f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            else:
+                f.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:  # Gives up after 10 seconds, keep waiting
+                        continue
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+def _read_index(data_folder: str) -> dict[str, dict[str, float]]:
+    index_file = Path(data_folder) / INDEX_FILE
+    try:
+        with open(index_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _write_json(path: Path, data: dict) -> None:
+    """Replace JSON file atomically, so readers in other processes never see it half written."""
+    tmp_file = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_file, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_file, path)
+
+def _write_index(data_folder: str, index: dict[str, dict[str, float]]) -> None:
+    _write_json(Path(data_folder) / INDEX_FILE, index)
+
+def touch_cached_file(data_folder: str, filename: str) -> None:
+    """Register use of a cached file in the cache index."""
+    path = Path(data_folder) / filename
+    if not path.exists():
+        return
+    now = time.time()
+    with _file_lock(Path(data_folder) / INDEX_FILE, _index_lock):
+        index = _read_index(data_folder)
+        entry = index.setdefault(filename, {"created": now})
+        entry["size"] = path.stat().st_size
+        entry["accessed"] = now
+        _write_index(data_folder, index)
+
+def evict(
+    data_folder: str,
+    max_bytes: int = CACHE_MAX_BYTES,
+    max_age: float = CACHE_MAX_AGE,
+    keep: frozenset[str] = frozenset(),
+) -> list[str]:
+    """Remove files not used for `max_age` seconds, then least recently used
+    files until the folder fits into `max_bytes`. Returns removed file names.
+
+    Files named in `keep` (e.g. just stored) are never removed, even if
+    they alone exceed the budget.
+    """
+    folder = Path(data_folder)
+    if not folder.exists():
+        return []
+    removed = []
+    with _file_lock(folder / INDEX_FILE, _index_lock):
+        index = _read_index(data_folder)
+        # Files missing from the index (e.g. left by an interrupted run) are adopted
+        for path in folder.iterdir():
+            if (
+                path.is_file() and path.name not in (INDEX_FILE, DIGEST_FILE)
+                and not path.name.endswith((".tmp", LOCK_SUFFIX)) and path.name not in index
+            ):
+                stat = path.stat()
+                index[path.name] = {"created": stat.st_mtime, "accessed": stat.st_mtime, "size": stat.st_size}
+        index = {name: entry for name, entry in index.items() if (folder / name).exists()}
+        now = time.time()
+        total = sum(entry["size"] for entry in index.values())
+        for name, entry in sorted(index.items(), key=lambda item: item[1]["accessed"]):
+            if name in keep or (total <= max_bytes and now - entry["accessed"] <= max_age):
+                continue
+            try:
+                (folder / name).unlink()
+            except OSError:  # File is still in use
+                continue
+            total -= entry["size"]
+            del index[name]
+            removed.append(name)
+        _write_index(data_folder, index)
+    return removed
+
+
+
+def _read_digests() -> dict[str, str]:
+    try:
+        with open(default_cache_dir() / DIGEST_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _store_digest(key: str, digest: str) -> None:
+    """Add digest to the file shared by all processes, dropping the oldest entries."""
+    try:
+        default_cache_dir().mkdir(parents=True, exist_ok=True)
+    except OSError:  # Read-only cache, digest is only kept in memory
+        return
+    with _file_lock(default_cache_dir() / DIGEST_FILE, _digest_lock):
+        digests = _read_digests()
+        digests.pop(key, None)
+        digests[key] = digest
+        for old in list(digests)[:-DIGEST_MAX_ENTRIES]:
+            del digests[old]
+        try:
+            _write_json(default_cache_dir() / DIGEST_FILE, digests)
+        except OSError:
+            pass
+
+@lru_cache(maxsize=1024)
+def _file_digest(path: str, mtime_ns: int, size: int) -> str:
+    """Digest of file contents. Memoized per (path, mtime, size).
+
+    Digests are also stored on disk, so analyses running in new processes
+    (background callbacks, batch jobs) do not read unchanged files again.
+    """
+    key = f"{path}:{size}:{mtime_ns}"
+    stored = _read_digests().get(key)
+    if stored is not None:
+        return stored
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+    _store_digest(key, digest.hexdigest())
+    return digest.hexdigest()
+
+def file_signature(path: str) -> str:
+    """Describe file by size, modification time and content digest."""
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    return f"{stat.st_size}:{stat.st_mtime_ns}:{_file_digest(path, stat.st_mtime_ns, stat.st_size)}"
 
 def hash_parameters(
     k_files: list[str]|str,
     a_files: list[str],
     imputation: str,
     f_format: str,
+    **parameters,
 ) -> str:
-    """Create a hash from input parameters."""
-    hash_str = f"{sorted(k_files)}{sorted(a_files)}{imputation}{f_format}"
+    """Create a hash from input files and parameters.
+
+    Files are identified by their contents, so a file regenerated in place
+    gets a new hash. Keyword arguments are any other parameters affecting
+    the result (e.g. MaxQuant columns, number of neighbours for KNN,
+    Diffacto parameters).
+    """
+    if isinstance(k_files, str):
+        k_files = [k_files]
+    k_sigs = [(file, file_signature(file)) for file in sorted(k_files)]
+    a_sigs = [(file, file_signature(file)) for file in sorted(a_files)]
+    params = json.dumps(parameters, sort_keys=True, default=str)
+    hash_str = f"{k_sigs}{a_sigs}{imputation}{f_format}{params}"
     return hashlib.md5(hash_str.encode(), usedforsecurity=False).hexdigest()[:16]
 
+def _cached_file(hash: str, data_folder: str) -> Path | None:
+    """Find cache file for a hash in any of the supported formats."""
+    for suffix in (CACHE_SUFFIX, ".pkl"):
+        data_file = Path(data_folder) / f"{hash}{suffix}"
+        if data_file.exists():
+            return data_file
+    return None
+
 def check_existing_data(
     hash: str,
     data_folder: str,
@@ -27,10 +262,13 @@ def check_existing_data(
     """Check if data for given parameters is already present."""
     if not os.path.exists(data_folder):
         return None
-    data_file = Path(data_folder) / f"{hash}.csv"
-    if not data_file.exists():
+    data_file = _cached_file(hash, data_folder)
+    if data_file is None:
         return None
-    return pd.read_csv(data_file)
+    touch_cached_file(data_folder, data_file.name)
+    if data_file.suffix == ".feather" and feather is not None:
+        return feather.read_table(data_file, memory_map=True).to_pandas()
+    return pd.read_pickle(data_file)
 
 def save_data(
     df: pd.DataFrame,
@@ -40,4 +278,74 @@ def save_data(
     """Save data to file with a specific hash."""
     if not os.path.exists(data_folder):
         os.makedirs(data_folder)
-    df.to_csv(Path(data_folder) / f"{hash}.csv", index=False)
\ No newline at end of file
+    df = df.reset_index(drop=True)
+    data_file = Path(data_folder) / f"{hash}{CACHE_SUFFIX}"
+    if feather is not None:
+        # Uncompressed, so that reads can be memory-mapped
+        df.to_feather(data_file, compression="uncompressed")
+    else:
+        df.to_pickle(data_file)
+    touch_cached_file(data_folder, data_file.name)
+    evict(data_folder, keep=frozenset([data_file.name]))
+
+def check_existing_file(
+    hash: str,
+    data_folder: str,
+    name: str,
+) -> str | None:
+    """Check if a file with given name is cached for given parameters."""
+    data_file = Path(data_folder) / f"{hash}_{name}"
+    if not data_file.exists():
+        return None
+    touch_cached_file(data_folder, data_file.name)
+    return str(data_file)
+
+def store_file(
+    file: str,
+    hash: str,
+    data_folder: str,
+    name: str,
+) -> str:
+    """Move a file into cache with a specific hash. Returns new path of the file."""
+    if not os.path.exists(data_folder):
+        os.makedirs(data_folder)
+    data_file = Path(data_folder) / f"{hash}_{name}"
+    shutil.move(file, data_file)
+    touch_cached_file(data_folder, data_file.name)
+    evict(data_folder, keep=frozenset([data_file.name]))
+    return str(data_file)
+
+def fetch_file(
+    hash: str,
+    data_folder: str,
+    name: str,
+    dest: str,
+) -> bool:
+    """Link or copy a cached file to `dest`. Returns False if it is not cached.
+
+    The copy stays usable if the cache entry is evicted by another process.
+    A link shares contents with the cached file: `dest` may be removed or
+    replaced, but must not be written to.
+    """
+    data_file = check_existing_file(hash, data_folder, name)
+    if data_file is None:
+        return False
+    try:
+        try:
+            os.link(data_file, dest)
+        except OSError:
+            shutil.copyfile(data_file, dest)
+    except FileNotFoundError:  # Evicted meanwhile
+        return False
+    return True
+
+def export_data(
+    hash: str,
+    data_folder: str,
+    path: str,
+) -> None:
+    """Export cached data with a specific hash to a CSV file."""
+    df = check_existing_data(hash, data_folder)
+    if df is None:
+        raise FileNotFoundError(f"No cached data for hash {hash}")
+    df.to_csv(path, index=False)
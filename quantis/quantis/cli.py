@@ -0,0 +1,25 @@
+"""Command line entry point
+
+`quantis run ...` runs analyses headless (see `batch`), without importing
+Dash or pywebview. Any other arguments launch the GUI.
+`--import-times` prints how long imports took before the GUI opens.
+
+Copyright 2024 Daniil Pomogaev
+SPDX-License-Identifier: Apache-2.0
+"""
+
+import os
+import sys
+
+from . import import_times
+
+
+def main():
+    if "--import-times" in sys.argv:
+        os.environ["QUANTIS_IMPORT_TIMES"] = "1"
+    import_times.enable()
+    if len(sys.argv) > 1 and sys.argv[1] == "run":
+        from .batch import main as batch_main
+        sys.exit(batch_main(sys.argv[2:]))
+    from .app import launch_from_cli
+    launch_from_cli()
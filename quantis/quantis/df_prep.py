@@ -7,9 +7,89 @@ SPDX-License-Identifier: Apache-2.0
 
 import os
 import pandas as pd
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator
 
 
-def load_from_sample_file(s_file_path: str) -> pd.DataFrame:
+# Called with number of files read so far and total number of files
+FileProgress = Callable[[int, int], None]
+
+READ_WORKERS = min(8, os.cpu_count() or 1)
+KEY_COLS = ['dbname', 'description']
+
+
+def iter_tables(
+    files: list[str],
+    workers: int | None = None,
+    progress: FileProgress | None = None,
+    **kwargs,
+) -> Iterator[pd.DataFrame]:
+    """Read tab-separated files concurrently, yielding tables in the order of `files`.
+
+    At most `workers` files are parsed or held at once, so memory stays bounded
+    for large inputs. `workers=1` reads files one by one.
+    `progress` is called after every file read.
+    Extra keyword arguments are passed to `pd.read_csv`.
+    """
+    for i, table in enumerate(_iter_tables(files, workers, **kwargs), start=1):
+        if progress is not None:
+            progress(i, len(files))
+        yield table
+
+
+def _iter_tables(files: list[str], workers: int | None, **kwargs) -> Iterator[pd.DataFrame]:
+    workers = workers or READ_WORKERS
+    if workers <= 1 or len(files) <= 1:
+        for file in files:
+            yield pd.read_csv(file, sep='\t', **kwargs)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for file in files:
+            pending.append(pool.submit(pd.read_csv, file, sep='\t', **kwargs))
+            if len(pending) >= workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def read_tables(
+    files: list[str],
+    workers: int | None = None,
+    progress: FileProgress | None = None,
+    **kwargs,
+) -> list[pd.DataFrame]:
+    """Read tab-separated files concurrently. Tables are returned in the order of `files`."""
+    return list(iter_tables(files, workers, progress, **kwargs))
+
+
+def _run_labels(k_files: list[str], a_files: list[str]) -> list[str]:
+    """Column labels for runs in K, A order: NSAF_K_1, ..., NSAF_A_1, ..."""
+    return [f'NSAF_{s}_{i}' for s, flist in zip(['K', 'A'], [k_files, a_files]) for i in range(1, len(flist) + 1)]
+
+
+def _join_runs(runs: list[pd.DataFrame]) -> pd.DataFrame:
+    """Join per-run tables on protein keys in a single step.
+
+    Every table is expected to have 'dbname', 'description' and one value column.
+    Equivalent to consecutive outer merges on the keys, but aligns all runs at once,
+    so the cost grows linearly with the number of runs. Keys repeated within a run
+    pair up with every match of the other runs, so such tables are still merged.
+    """
+    df = pd.DataFrame(columns=KEY_COLS)
+    indexed = [run.set_index(KEY_COLS) for run in runs]
+    if not runs:
+        return df
+    if any(run.index.has_duplicates for run in indexed):
+        for run in runs:
+            df = df.merge(run, on=KEY_COLS, how='outer')
+        return df
+    df = pd.concat(indexed, axis=1, join='outer').sort_index()
+    return df.reset_index()
+
+
+def load_from_sample_file(s_file_path: str, workers: int | None = None) -> pd.DataFrame:
     """Load sample data wih specifications from sample file.
     
     Returns single pd.DataFrame with columns:
@@ -26,18 +106,21 @@ def load_from_sample_file(s_file_path: str) -> pd.DataFrame:
     
     samples = pd.read_csv(s_file_path, sep='\t')  # Sample file has columns: Sample, Run, Path
 
-    df = pd.DataFrame(columns=['dbname', 'description'])
-
-    for file in samples.itertuples():
-        sample = pd.read_csv(str(file.Path), sep='\t')
+    paths = [str(path) for path in samples['Path']]
+    runs = []
+    for file, sample in zip(samples.itertuples(), iter_tables(paths, workers)):
         sample = sample[['dbname', 'description', 'NSAF']]
-        sample.rename(columns={'NSAF': f'NSAF_{file.Sample}_{file.Run}'}, inplace=True)
-        df = df.merge(sample, on=['dbname', 'description'], how='outer')
+        runs.append(sample.rename(columns={'NSAF': f'NSAF_{file.Sample}_{file.Run}'}))
 
-    return df
+    return _join_runs(runs)
 
 
-def load_from_lists(k_files: list[str], a_files: list[str]) -> pd.DataFrame:
+def load_from_lists(
+    k_files: list[str],
+    a_files: list[str],
+    workers: int | None = None,
+    progress: FileProgress | None = None,
+) -> pd.DataFrame:
     """Load sample data from lists of files.
 
     Returns single pd.DataFrame with columns:
@@ -45,20 +128,22 @@ def load_from_lists(k_files: list[str], a_files: list[str]) -> pd.DataFrame:
     - 'description' - protein description
     - 'NSAF_x_y' - NSAF value for sample x, run y (multiple columns)
     """
-    df = pd.DataFrame(columns=['dbname', 'description'])
+    labels = _run_labels(k_files, a_files)
+    runs = []
 
-    # Iterate over two lists: k with control samples and a with experimental samples
-    for s, flist in zip(['K', 'A'], [k_files, a_files]): # s - sample type, flist - list of files
-        for i, file in enumerate(flist, start=1): # i - run number, file - file path
-            sample = pd.read_csv(file, sep='\t')
-            sample = sample[['dbname', 'description', 'NSAF']]
-            sample.rename(columns={'NSAF': f'NSAF_{s}_{i}'}, inplace=True)
-            df = df.merge(sample, on=['dbname', 'description'], how='outer')
+    for label, sample in zip(labels, iter_tables(k_files + a_files, workers, progress)):
+        sample = sample[['dbname', 'description', 'NSAF']]
+        runs.append(sample.rename(columns={'NSAF': label}))
 
-    return df
+    return _join_runs(runs)
 
 
-def load_from_lists_mq(k_files: list[str], a_files: list[str]) -> pd.DataFrame:
+def load_from_lists_mq(
+    k_files: list[str],
+    a_files: list[str],
+    workers: int | None = None,
+    progress: FileProgress | None = None,
+) -> pd.DataFrame:
     """Load data from lists of file paths. Adjust MaxQuant format for further usage.
     
     Just as well, returns single pd.DataFrame with columns:
@@ -68,14 +153,13 @@ def load_from_lists_mq(k_files: list[str], a_files: list[str]) -> pd.DataFrame:
 
     Name discrepancy is added for cross-compatibiblity.
     """
-    df = pd.DataFrame(columns=['dbname', 'descripton'])
+    labels = _run_labels(k_files, a_files)
+    runs = []
 
-    for s, flist in zip(['K', 'A'], [k_files, a_files]):
-        for i, file in enumerate(flist, start=1):
-            sample = pd.read_csv(file, sep='\t')
-            sample['dbname'] = sample['Protein IDs'].apply(lambda l: (l[0] if isinstance(l, list) else l))
-            sample['description'] = sample['Gene names'].apply(lambda l: (l[0] if isinstance(l, list) else l))
-            sample[f'NSAF_{s}_{i}'] = sample['iBAQ']/sample['iBAQ'].sum()
-            df = df.merge(sample, on=['dbname', 'description'], how='outer')
+    for label, sample in zip(labels, iter_tables(k_files + a_files, workers, progress)):
+        sample['dbname'] = sample['Protein IDs'].apply(lambda l: (l[0] if isinstance(l, list) else l))
+        sample['description'] = sample['Gene names'].apply(lambda l: (l[0] if isinstance(l, list) else l))
+        sample[label] = sample['iBAQ']/sample['iBAQ'].sum()
+        runs.append(sample[['dbname', 'description', label]])
 
-    return df
\ No newline at end of file
+    return _join_runs(runs)
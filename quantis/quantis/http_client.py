@@ -0,0 +1,79 @@
+"""Shared HTTP client for STRING and NCBI requests
+
+All requests go through one session, so connections are kept alive and
+reused. Every request has a timeout, and failed connections and
+overloaded servers (429, 5xx) are retried with exponential backoff.
+
+Base URLs can be changed with QUANTIS_STRING_URL and QUANTIS_NCBI_URL,
+e.g. to point at a local stand-in server in tests or air-gapped sites.
+
+Copyright 2024 Daniil Pomogaev
+SPDX-License-Identifier: Apache-2.0
+"""
+
+import os
+import threading
+from typing import Literal, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import requests
+
+Service = Literal["string", "ncbi"]
+
+BASE_URLS: dict[Service, str] = {
+    "string": os.environ.get("QUANTIS_STRING_URL", "https://string-db.org/api/"),
+    "ncbi": os.environ.get("QUANTIS_NCBI_URL", "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"),
+}
+# Connect and read timeouts, in seconds
+TIMEOUT = (5, float(os.environ.get("QUANTIS_HTTP_TIMEOUT", 60)))
+RETRIES = 3
+BACKOFF = 0.5
+POOL_SIZE = 8
+
+_session: "requests.Session | None" = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> "requests.Session":
+    """Return shared session, creating it on first use."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+
+            retry = Retry(
+                total=RETRIES, backoff_factor=BACKOFF,
+                status_forcelist=(429, 500, 502, 503, 504),
+                # STRING API takes queries as POST, they are safe to repeat
+                allowed_methods=None,
+                respect_retry_after_header=True,
+            )
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+        return _session
+
+
+def url(service: Service, path: str) -> str:
+    """Full URL of `path` on the service."""
+    return BASE_URLS[service].rstrip("/") + "/" + path.lstrip("/")
+
+
+def request(method: str, service: Service, path: str, **kwargs) -> "requests.Response":
+    """Send request to the service. Raises `requests.HTTPError` on error responses."""
+    kwargs.setdefault("timeout", TIMEOUT)
+    response = get_session().request(method, url(service, path), **kwargs)
+    response.raise_for_status()
+    return response
+
+
+def get(service: Service, path: str, **kwargs) -> "requests.Response":
+    return request("GET", service, path, **kwargs)
+
+
+def post(service: Service, path: str, **kwargs) -> "requests.Response":
+    return request("POST", service, path, **kwargs)
@@ -0,0 +1,90 @@
+"""Import time report for startup profiling
+
+Works like `python -X importtime`, but also in frozen executables.
+Set QUANTIS_IMPORT_TIMES=1 (or pass `--import-times` to `quantis`) and the
+time spent importing every top-level package is printed before the
+window opens.
+
+Copyright 2024 Daniil Pomogaev
+SPDX-License-Identifier: Apache-2.0
+"""
+
+import os
+import sys
+import time
+from collections import defaultdict
+
+_self_times: dict[str, float] = defaultdict(float)
+_stack: list[float] = []
+_started: float | None = None
+
+
+class _TimedLoader:
+    """Loader of a single module that times `exec_module` of the original loader.
+
+    Loaders can be shared by many modules (zipimporter, frozen importers),
+    so they are wrapped per module and never modified.
+    """
+
+    def __init__(self, loader, fullname: str):
+        self._loader = loader
+        self._fullname = fullname
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        _stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            self._loader.exec_module(module)
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = _stack.pop()
+            _self_times[self._fullname.partition(".")[0]] += elapsed - nested
+            if _stack:
+                _stack[-1] += elapsed
+            # Module keeps its real loader once loaded
+            module.__loader__ = self._loader
+            if getattr(module, "__spec__", None) is not None and module.__spec__.loader is self:
+                module.__spec__.loader = self._loader
+
+
+class _TimingFinder:
+    """Meta path finder that times execution of modules found by other finders."""
+
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        if spec.loader is None or not hasattr(spec.loader, "exec_module"):
+            return spec
+        spec.loader = _TimedLoader(spec.loader, fullname)
+        return spec
+
+
+def enable() -> None:
+    """Start timing imports if QUANTIS_IMPORT_TIMES is set."""
+    global _started
+    if not os.environ.get("QUANTIS_IMPORT_TIMES") or _started is not None:
+        return
+    _started = time.perf_counter()
+    sys.meta_path.insert(0, _TimingFinder())
+
+
+def report(top: int = 15) -> None:
+    """Print import time of the slowest top-level packages since `enable`."""
+    if _started is None:
+        return
+    total = sum(_self_times.values())
+    print(f"Startup: {time.perf_counter() - _started:.2f} s, imports: {total:.2f} s", file=sys.stderr)
+    for package, seconds in sorted(_self_times.items(), key=lambda item: -item[1])[:top]:
+        print(f"{seconds:8.3f} s  {package}", file=sys.stderr)
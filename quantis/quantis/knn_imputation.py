@@ -1,20 +1,122 @@
 """knn imputation for nsaf columns
 
+Rows without missing values are donors. For every row with missing values
+the nearest donors are found by nan-euclidean distance, i.e. euclidean
+distance over the present coordinates, and missing values are replaced with
+the mean of donor values, same as `sklearn.impute.KNNImputer` with uniform
+weights.
+
+Incomplete rows are processed in blocks on several threads. Block size
+is chosen so that distance temporaries of all threads together fit into
+BLOCK_MEMORY. With `algorithm="tree"` rows are
+grouped by missing value pattern and neighbours are searched with a
+tree index built for each pattern.
+
 Copyright 2024 Daniil Pomogaev
 SPDX-License-Identifier: Apache-2.0
 """
 
-from sklearn.impute import KNNImputer
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Literal
+
+import numpy as np
 import pandas as pd
 
+KNN_algorithm = Literal["brute", "tree"]
+
+# Memory for distance temporaries of all blocks processed at once, in bytes
+BLOCK_MEMORY = 64 * 2**20
+# Block x donor float64 arrays alive at once while a block is processed:
+# partial products, distances and the argpartition result
+BLOCK_TEMPORARIES = 3
+
+
+def _impute_block(block: np.ndarray, donors: np.ndarray, donors_sq: np.ndarray, k: int) -> np.ndarray:
+    """Impute a block of rows by brute force search among all donors."""
+    present = ~np.isnan(block)
+    filled = np.where(present, block, 0)
+    # Squared distance over present coordinates: |x|^2 - 2 x.y + |y|^2
+    dist = (filled ** 2).sum(axis=1)[:, None] - 2 * filled @ donors.T + present.astype(float) @ donors_sq.T
+    if k < donors.shape[0]:
+        nearest = np.argpartition(dist, k - 1, axis=1)[:, :k]
+    else:
+        nearest = np.broadcast_to(np.arange(donors.shape[0]), (block.shape[0], donors.shape[0]))
+    means = donors[nearest].mean(axis=1)
+    # Rows without any present values get column means, as in KNNImputer
+    means[~present.any(axis=1)] = donors.mean(axis=0)
+    return np.where(present, block, means)
+
+
+def _impute_tree(values: np.ndarray, donors: np.ndarray, k: int, n_jobs: int) -> np.ndarray:
+    """Impute rows using a tree index for every pattern of missing values."""
+    from sklearn.neighbors import NearestNeighbors
+
+    result = values.copy()
+    present = ~np.isnan(values)
+    patterns, inverse = np.unique(present, axis=0, return_inverse=True)
+    for p, pattern in enumerate(patterns):
+        rows = np.flatnonzero(inverse.ravel() == p)
+        if not pattern.any():
+            result[np.ix_(rows, ~pattern)] = donors.mean(axis=0)
+            continue
+        index = NearestNeighbors(n_neighbors=k, algorithm="auto", n_jobs=n_jobs).fit(donors[:, pattern])
+        nearest = index.kneighbors(values[np.ix_(rows, pattern)], return_distance=False)
+        result[np.ix_(rows, ~pattern)] = donors[nearest][:, :, ~pattern].mean(axis=1)
+    return result
+
+
+def knn_impute_values(
+    values: np.ndarray,
+    donors: np.ndarray,
+    n_neighbors: int = 5,
+    algorithm: KNN_algorithm = "brute",
+    block_size: int | None = None,
+    n_jobs: int | None = None,
+) -> np.ndarray:
+    """Impute NaN in `values` from the nearest rows of complete `donors` matrix.
+
+    With the brute force algorithm peak memory of distance computations is
+    about `BLOCK_TEMPORARIES * 8 * block_size * len(donors) * n_jobs` bytes,
+    which is at most BLOCK_MEMORY when `block_size` is not given.
+    """
+    if donors.shape[0] == 0:
+        raise ValueError("No rows without missing values to impute from")
+    k = min(n_neighbors, donors.shape[0])
+    n_jobs = n_jobs or os.cpu_count() or 1
+    if values.shape[0] == 0:
+        return values.copy()
+    if algorithm == "tree":
+        return _impute_tree(values, donors, k, n_jobs)
+
+    if block_size is None:
+        # Budget is shared by all threads
+        block_size = max(1, BLOCK_MEMORY // (BLOCK_TEMPORARIES * 8 * donors.shape[0] * n_jobs))
+    donors_sq = donors ** 2
+    blocks = [values[i:i + block_size] for i in range(0, values.shape[0], block_size)]
+    if n_jobs == 1 or len(blocks) == 1:
+        imputed = [_impute_block(block, donors, donors_sq, k) for block in blocks]
+    else:
+        with ThreadPoolExecutor(max_workers=min(n_jobs, len(blocks))) as pool:
+            imputed = list(pool.map(lambda block: _impute_block(block, donors, donors_sq, k), blocks))
+    return np.concatenate(imputed)
+
 
-def knn_impute(df: pd.DataFrame, n_neighbors: int = 5) -> pd.DataFrame:
+def knn_impute(
+    df: pd.DataFrame,
+    n_neighbors: int = 5,
+    algorithm: KNN_algorithm = "brute",
+    block_size: int | None = None,
+    n_jobs: int | None = None,
+) -> pd.DataFrame:
     """Impute missing values using K-Nearest Neighbors algorithm."""
-    imputer = KNNImputer(n_neighbors=n_neighbors, weights='uniform', metric='nan_euclidean')
     NSAF_cols = [col for col in df.columns if col.startswith('NSAF')]
     df['% NaN'] = df[NSAF_cols].isna().sum(axis=1) / len(NSAF_cols)
     df0 = df[df['% NaN'] == 0].copy(deep=True)[NSAF_cols]
     dfknn = df[df['% NaN'] != 0].copy(deep=True)[NSAF_cols]
-    imputer.fit(df0)
-    dfknn = pd.DataFrame(imputer.transform(dfknn), columns=dfknn.columns, index=dfknn.index)
-    return pd.concat([df0, dfknn]).reset_index()
\ No newline at end of file
+    imputed = knn_impute_values(
+        dfknn.to_numpy(dtype=float), df0.to_numpy(dtype=float),
+        n_neighbors, algorithm, block_size, n_jobs
+    )
+    dfknn = pd.DataFrame(imputed, columns=dfknn.columns, index=dfknn.index)
+    return pd.concat([df0, dfknn]).reset_index()
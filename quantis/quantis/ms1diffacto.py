@@ -9,9 +9,21 @@ SPDX-License-Identifier: Apache-2.0
 import pandas as pd
 from subprocess import run
 import os
-from typing import NamedTuple, TypedDict, Literal
+from typing import Callable, NamedTuple, TypedDict, Literal
+
+from .df_prep import iter_tables, FileProgress
 
 DiffactoNormMethod = Literal['average','median','GMM','None']
+# Protein quantification for s+d: Diffacto executable or `rollup.rollup_proteins`
+QuantEngine = Literal['diffacto', 'builtin']
+
+PFM_COLUMNS = ['sequence', 'charge', 'ion_mobility', 'Intensity', 'proteins']
+
+# Called with number of bytes written so far and fraction of rows written
+WriteProgress = Callable[[int, float], None]
+
+# Approximate size of text formatted at once when writing peptides file, in bytes
+WRITE_CHUNK_BYTES = 32 * 2**20
 
 
 class DiffactoInputFiles(NamedTuple):
@@ -45,104 +57,181 @@ def are_files_present(file: str) -> bool:
     return True
 
 
-def compile_diffacto_data(sample1: list[str], sample2: list[str], outdir: str) -> DiffactoInputFiles:
-    sample_file = os.path.join(outdir, 'samples.txt')
-    peptides_file = os.path.join(outdir, 'peptides.txt')
+def run_files(file: str) -> list[str]:
+    """All files of a single run: proteins, PFMs_ML and PFMs tables."""
+    return [file.replace('_proteins.tsv', suf) for suf in ("_proteins.tsv", "_PFMs_ML.tsv", "_PFMs.tsv")]
+
+
+def write_peptides(
+    df: pd.DataFrame,
+    columns: list[str],
+    path: str,
+    progress: WriteProgress | None = None,
+    chunk_bytes: int = WRITE_CHUNK_BYTES,
+) -> int:
+    """Write table to CSV in chunks of about `chunk_bytes` of text. Returns bytes written.
+
+    Only one chunk of rows is copied and formatted at a time, so memory
+    stays bounded whatever the size of the file.
+    """
+    sample = df.iloc[:1000][columns].to_csv(header=False)
+    row_bytes = max(1, len(sample.encode()) // max(1, min(len(df), 1000)))
+    chunk_rows = max(1, chunk_bytes // row_bytes)
+    with open(path, 'w', newline='') as f:
+        df.iloc[:0][columns].to_csv(f, sep=',')
+        for start in range(0, len(df), chunk_rows):
+            df.iloc[start:start + chunk_rows][columns].to_csv(f, sep=',', header=False)
+            if progress is not None:
+                progress(f.tell(), min(1.0, (start + chunk_rows) / len(df)))
+        return f.tell()
+
+
+def run_label(file: str) -> str:
+    """Sample label of a run, as used in peptide matrix columns."""
+    return file.replace('_proteins.tsv', '')
+
+
+def compile_peptide_matrix(
+    sample1: list[str],
+    sample2: list[str],
+    workers: int | None = None,
+    progress: FileProgress | None = None,
+) -> pd.DataFrame:
+    """Build peptide x run intensity matrix from Scavager runs.
+
+    Indexed by peptide (sequence, charge and ion mobility), with `proteins`,
+    `origseq`, `intensity_median` and `nummissing` columns and one intensity
+    column per run, labelled by `run_label`.
+    `progress` is called after every file read.
+    """
     replace_label = '_proteins.tsv'
     
-    df_final = None
-
-    allowed_prots = set()
-    allowed_peptides = set()
-    allowed_prots_all = set()
-
     all_labels = []
-
-    for sample in (sample1, sample2):
-        for z in sample:
-            df0 = pd.read_table(z)
-            allowed_prots.update(df0['dbname'])
-
-    for sample in (sample1, sample2):
-        for z in sample:
-            df0 = pd.read_table(z.replace('_proteins.tsv', '_PFMs_ML.tsv'))
-            df0 = df0[df0['qpreds'] <= 10]
-            allowed_peptides.update(df0['seqs'])
-
-    # for num, sample in zip(('S1', 'S2'), (sample1, sample2)):
-    for sample in (sample1, sample2):
-        if sample:
-            for z in sample:
-                df3 = pd.read_table(z.replace('_proteins.tsv', '_PFMs.tsv'))
-                df3 = df3[df3['sequence'].apply(lambda x: x in allowed_peptides)]
-
-                df3_tmp = df3[df3['proteins'].apply(lambda x: any(z in allowed_prots for z in x.split(';')))]
-                for dbnames in set(df3_tmp['proteins'].values):
-                    for dbname in dbnames.split(';'):
-                        allowed_prots_all.add(dbname)
-
-    for sample in (sample1, sample2):
-        for z in sample:
-            label = z.replace(replace_label, '')
-            all_labels.append(label)
-            df3 = pd.read_table(z.replace(replace_label, '_PFMs.tsv'))  # read PFMs
-
-            df3 = df3[df3['proteins'].apply(lambda x: any(z in allowed_prots_all for z in x.split(';')))]
-            df3['proteins'] = df3['proteins'].apply(lambda x: ';'.join([z for z in x.split(';') if z in allowed_prots_all]))
-
-            df3['origseq'] = df3['sequence']
-            df3['sequence'] = df3['sequence'] + df3['charge'].astype(int).astype(str) + df3['ion_mobility'].astype(str)
-
-            df3 = df3.sort_values(by='Intensity', ascending=False)
-            df3 = df3.drop_duplicates(subset='sequence')
-            # df3 = df3.explode('proteins')
-
-            df3[label] = df3['Intensity']
-            df3['protein'] = df3['proteins']
-            df3['peptide'] = df3['sequence']
-            df3 = df3[['origseq', 'peptide', 'protein', label]]
-
-            if df_final is None:
-                df_final = df3.reset_index(drop=True)
-            else:
-                df_final = df_final.reset_index(drop=True).merge(df3.reset_index(drop=True), on='peptide', how='outer')
-                df_final['protein_x'].fillna(value=df_final['protein_y'], inplace=True)
-                df_final['origseq_x'].fillna(value=df_final['origseq_y'], inplace=True)
-                df_final['protein'] = df_final['protein_x']
-                df_final['origseq'] = df_final['origseq_x']
-
-                df_final = df_final.drop(columns=['protein_x', 'protein_y'])
-                df_final = df_final.drop(columns=['origseq_x', 'origseq_y'])
-
-    assert df_final is not None
+    intensities = []
+    peptide_info = []
+
+    files = sample1 + sample2
+
+    def pass_progress(n_pass: int) -> FileProgress | None:
+        """Report files read over all three passes."""
+        if progress is None:
+            return None
+        return lambda i, n: progress(n_pass * n + i, 3 * n)
+
+    allowed_prots = pd.Index(pd.concat(
+        [df0['dbname'] for df0 in iter_tables(files, workers, pass_progress(0), usecols=['dbname'])],
+        ignore_index=True
+    ).unique())
+
+    allowed_peptides = pd.Index(pd.concat(
+        [df0.loc[df0['qpreds'] <= 10, 'seqs'] for df0 in iter_tables(
+            [z.replace('_proteins.tsv', '_PFMs_ML.tsv') for z in files], workers, pass_progress(1),
+            usecols=['seqs', 'qpreds']
+        )],
+        ignore_index=True
+    ).unique())
+
+    # PFMs are read once. Until proteins of all runs are known, every run is kept
+    # compactly: text columns as categoricals and proteins split into one entry
+    # per protein as (row, protein code) arrays
+    pfms = []
+    matched_prots = []
+    pfm_files = [z.replace(replace_label, '_PFMs.tsv') for z in files]
+    for df3 in iter_tables(pfm_files, workers, pass_progress(2), usecols=PFM_COLUMNS):
+        prots = df3['proteins'].str.split(';').explode()
+        # Proteins of peptides that pass ML filter and belong to an identified protein
+        matched = prots.isin(allowed_prots).groupby(level=0, sort=False).any()
+        rows = matched.index[matched & df3['sequence'].isin(allowed_peptides)]
+        matched_prots.append(pd.Index(prots[prots.index.isin(rows)].unique()))
+        codes, uniques = pd.factorize(prots, use_na_sentinel=False)
+        entries = (prots.index.to_numpy(), codes, uniques)
+        del prots
+        pfms.append((df3.astype({'sequence': 'category', 'proteins': 'category'}), entries))
+    allowed_prots_all = matched_prots[0].append(matched_prots[1:]).unique() if matched_prots else pd.Index([])
+
+    for z in files:
+        df3, (entry_rows, codes, uniques) = pfms.pop(0)
+        label = run_label(z)
+        all_labels.append(label)
+
+        allowed = uniques.isin(allowed_prots_all)[codes]
+        df3 = df3[df3.index.isin(entry_rows[allowed])]
+        df3 = df3.astype({'sequence': object, 'proteins': object})
+        # Only rows that lost some of their proteins are joined again
+        changed = df3.index.intersection(entry_rows[~allowed])
+        if len(changed):
+            kept = allowed & pd.Index(entry_rows).isin(changed)
+            kept = pd.Series(uniques[codes[kept]], index=entry_rows[kept])
+            df3.loc[changed, 'proteins'] = kept.groupby(level=0, sort=False).agg(';'.join)
+
+        df3['origseq'] = df3['sequence']
+        df3['sequence'] = df3['sequence'] + df3['charge'].astype(int).astype(str) + df3['ion_mobility'].astype(str)
+
+        df3 = df3.sort_values(by='Intensity', ascending=False)
+        df3 = df3.drop_duplicates(subset='sequence')
+        # df3 = df3.explode('proteins')
+
+        intensities.append(df3.set_index('sequence')['Intensity'].rename(label))
+        peptide_info.append(df3[['sequence', 'proteins', 'origseq']])
+
+    # Peptide x run matrix aligned in one step. A run with missing peptides gets NaN
+    # (and float dtype), like with consecutive outer merges on the peptide
+    matrix = pd.concat(intensities, axis=1)
+    matrix.index.name = 'peptide'
+    # Protein and sequence of a peptide are taken from the first run it was found in
+    info = pd.concat(peptide_info, ignore_index=True).drop_duplicates(subset='sequence').set_index('sequence')
+    info = info.reindex(matrix.index)
+    if len(all_labels) == 1:
+        df_final = pd.concat([info['origseq'], info['proteins'].rename('protein'), matrix], axis=1)
+        df_final = df_final.reset_index()[['origseq', 'peptide', 'protein', *all_labels]]
+    else:
+        # Outer merges sort peptides
+        df_final = matrix.assign(protein=info['proteins'], origseq=info['origseq']).sort_index().reset_index()
     df_final['intensity_median'] = df_final[all_labels].median(axis=1)
     df_final['nummissing'] = df_final[all_labels].isna().sum(axis=1)
     df_final = df_final.sort_values(by=['nummissing', 'intensity_median'], ascending=(True, False))
     df_final = df_final.drop_duplicates(subset=('origseq', 'protein'))
-    df_final = df_final.set_index('peptide')
-    df_final['proteins'] = df_final['protein']
-    df_final = df_final.drop(columns=['protein'])
+    return df_final.rename(columns={'protein': 'proteins'}).set_index('peptide')
+
+
+def compile_diffacto_data(
+    sample1: list[str],
+    sample2: list[str],
+    outdir: str,
+    workers: int | None = None,
+    progress: FileProgress | None = None,
+    write_progress: WriteProgress | None = None,
+) -> DiffactoInputFiles:
+    """Compile peptides and samples files for Diffacto from Scavager runs.
+
+    `progress` is called after every file read, `write_progress` after every
+    chunk of peptides file written (see `write_peptides`).
+    """
+    sample_file = os.path.join(outdir, 'samples.txt')
+    peptides_file = os.path.join(outdir, 'peptides.txt')
+
+    df_final = compile_peptide_matrix(sample1, sample2, workers, progress)
     cols = df_final.columns.tolist()
     cols.remove('proteins')
     cols.insert(0, 'proteins')
-    df_final = df_final[cols]
-    df_final.fillna(value='')
-    df_final.to_csv(peptides_file, sep=',')
+    write_peptides(df_final, cols, peptides_file, write_progress)
     
     with open(sample_file, 'w') as out:
         for num, sample in zip(('S1', 'S2'), (sample1, sample2)):
             for z in sample:
-                label = z.replace(replace_label, '')
-                out.write(label + '\t' + num + '\n') 
+                out.write(run_label(z) + '\t' + num + '\n') 
     return DiffactoInputFiles(peptides_file, sample_file)
 
 
 def run_diffacto(input: DiffactoInputFiles, diffacto_path: str, parameters: DiffactoParameters, outdir: str) -> DiffactoOutput:
-    out = DiffactoOutput.from_dir(outdir)
+    """Run Diffacto with output, and any other files it writes, in `outdir`."""
+    out = DiffactoOutput.from_dir(os.path.abspath(outdir))
+    if os.path.dirname(diffacto_path):
+        diffacto_path = os.path.abspath(diffacto_path)
     run([
-        diffacto_path, '-i', input.peptides, '-s', input.samples, '-o', out,
+        diffacto_path, '-i', os.path.abspath(input.peptides), '-s', os.path.abspath(input.samples), '-o', out,
         '-normalize', parameters['normalize'],
         '-impute_threshold', str(parameters['impute_threshold']),
         '-min_samples', str(parameters['min_samples'])
-    ], check=True)
+    ], check=True, cwd=outdir)
     return out
\ No newline at end of file
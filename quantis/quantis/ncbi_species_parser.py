@@ -3,15 +3,14 @@
 Copyright 2024 Daniil Pomogaev
 SPDX-License-Identifier: Apache-2.0
 """
-import requests
 import xml.etree.ElementTree as ET
 
+from . import http_client
+
 
 def fetch_species_name(taxid: int|str) -> str:
     """Fetch species name by taxonomy ID from NCBI database."""
-    url = f"https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi?db=taxonomy&id={taxid}"
-    response = requests.get(url)
-    response.raise_for_status()
+    response = http_client.get("ncbi", "esummary.fcgi", params={"db": "taxonomy", "id": taxid})
     data = ET.fromstring(response.text)
     for item in data[0]:
         if item.tag == 'Item' and item.attrib['Name'] == 'ScientificName':
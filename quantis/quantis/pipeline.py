@@ -0,0 +1,347 @@
+"""Memoized stages of the Quantis analysis pipeline.
+
+Steps from `utils` are grouped into stages, forming a chain:
+load (load -> impute -> FC/p) -> MTC -> thresholds -> classify -> select, plot
+
+Each stage result is kept in memory under a key built from the key of the
+stage it depends on and its own parameters. A change of parameters only
+reruns the stages downstream of it: moving threshold sliders reuses loaded
+and corrected data, changing colours only rebuilds the plot.
+
+The memo lives in the process that runs the pipeline. The app runs every
+analysis in a new background process, so there it only helps within one
+run; stage results that outlive a run come from the disk cache.
+
+Copyright 2024 Daniil Pomogaev
+SPDX-License-Identifier: Apache-2.0
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, NamedTuple
+
+import pandas as pd
+from plotly.graph_objects import Figure
+
+from .cash_or_new import (
+    hash_parameters, check_existing_data, save_data, check_existing_file, store_file, fetch_file,
+)
+from .ms1diffacto import (
+    DiffactoInputFiles, DiffactoParameters, QuantEngine,
+    compile_diffacto_data, compile_peptide_matrix, run_diffacto, run_files, run_label,
+)
+from .rollup import rollup_proteins
+from .utils import (
+    DFwThresholds, OneGroupDF, TwoGroupDF, Thresholds, ColorScheme,
+    MTC_method, ThC_method, REG_types,
+    load_data_scavager, load_data_maxquant, load_data_directms1quant, load_data_diffacto,
+    impute_missing_values, calculate_fold_change_p_value,
+    apply_mtc, mtc_thresholds, calculate_thresholds, calculate_thresholds_directms1quant,
+    replace_thresholds, classify_regulation, select_regulated, build_volcano_plot,
+)
+
+MEMO_SIZE = 64
+
+# Called with fraction of work done and a message describing the current step
+Progress = Callable[[float, str], None]
+
+_memo: OrderedDict[str, Any] = OrderedDict()
+_memo_lock = threading.Lock()
+
+
+class Staged(NamedTuple):
+    """Result of a pipeline stage with the key it is memoized under."""
+    key: str
+    value: Any
+
+
+class PipelineInput(NamedTuple):
+    """Input files and parameters that define loaded data."""
+    input_format: str
+    control_files: list[str]
+    test_files: list[str]
+    single_file: str
+    K_cols: list[str]
+    A_cols: list[str]
+    imputation: str
+    diffacto_path: str = ""
+    diffacto_parameters: DiffactoParameters | None = None
+    n_neighbors: int = 5
+    quant_engine: QuantEngine = "diffacto"
+
+
+def _memoized(stage: str, parent: str, params: Any, compute: Callable[[], Any]) -> Staged:
+    """Return memoized stage result or compute it.
+
+    Stage results are shared between calls and must not be modified.
+    """
+    key = hashlib.md5(f"{stage}{parent}{params!r}".encode(), usedforsecurity=False).hexdigest()[:16]
+    with _memo_lock:
+        if key in _memo:
+            _memo.move_to_end(key)
+            return Staged(key, _memo[key])
+    value = compute()
+    with _memo_lock:
+        _memo[key] = value
+        while len(_memo) > MEMO_SIZE:
+            _memo.popitem(last=False)
+    return Staged(key, value)
+
+
+def clear_memo() -> None:
+    """Drop all memoized stage results."""
+    with _memo_lock:
+        _memo.clear()
+
+
+def _no_progress(fraction: float, message: str) -> None:
+    pass
+
+
+def _file_progress(progress: Progress, message: str, share: float):
+    """Report files read as `share` of the whole run."""
+    return lambda i, n: progress(share * i / n, f"{message} {i}/{n}")
+
+
+def _imputation_parameters(pi: PipelineInput) -> dict:
+    """Imputation parameters that affect the result, for cache keys."""
+    return {"n_neighbors": pi.n_neighbors} if pi.imputation == "kNN" else {}
+
+
+@contextmanager
+def work_dir(files_path: str, run_id: str) -> Iterator[str]:
+    """Scratch directory of a single run under `files_path`, removed when done.
+
+    Every call gets its own directory, even for runs with the same ID,
+    so concurrent analyses never share their temporary files.
+    """
+    runs_path = os.path.join(files_path, "runs")
+    os.makedirs(runs_path, exist_ok=True)
+    path = tempfile.mkdtemp(prefix=f"{run_id}_", dir=runs_path)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def load_stage(pi: PipelineInput, cache_path: str, files_path: str, progress: Progress = _no_progress) -> Staged:
+    """Load data and calculate FC and p-value for every protein.
+
+    Results of Scavager and MaxQuant are also saved to disk cache,
+    as well as Diffacto input and output files for s+d. With the built-in
+    engine s+d runs in memory and only the protein table is cached.
+    """
+    fmt = pi.input_format
+    if fmt == "s+d" and pi.quant_engine == "builtin":
+        k_run_files = [rf for f in pi.control_files for rf in run_files(f)]
+        a_run_files = [rf for f in pi.test_files for rf in run_files(f)]
+        _hash = hash_parameters(k_run_files, a_run_files, "", fmt, diffacto=pi.diffacto_parameters, engine="builtin")
+
+        def compute():
+            assert pi.diffacto_parameters is not None
+            data = check_existing_data(_hash, cache_path)
+            if data is None:
+                peptides = compile_peptide_matrix(
+                    pi.control_files, pi.test_files,
+                    progress=_file_progress(progress, "Compiling peptides: reading files", 0.45),
+                )
+                progress(0.45, "Quantifying proteins")
+                data = rollup_proteins(
+                    peptides, [run_label(f) for f in pi.control_files], [run_label(f) for f in pi.test_files],
+                    pi.diffacto_parameters,
+                )
+                save_data(data, _hash, cache_path)
+            return load_data_diffacto(data)
+
+    elif fmt == "s+d":
+        k_run_files = [rf for f in pi.control_files for rf in run_files(f)]
+        a_run_files = [rf for f in pi.test_files for rf in run_files(f)]
+        _hash = hash_parameters(k_run_files, a_run_files, "", fmt, diffacto=pi.diffacto_parameters)
+
+        def compute():
+            assert pi.diffacto_parameters is not None
+            # Diffacto output depends on parameters, compiled input only on files
+            out = check_existing_file(_hash, cache_path, "diffacto_out.txt")
+            if out is not None:
+                try:
+                    return load_data_diffacto(out)
+                except FileNotFoundError:  # Evicted by another process
+                    pass
+            input_hash = hash_parameters(k_run_files, a_run_files, "", "diffacto_input")
+            # Diffacto works on copies in the run directory, which cache eviction
+            # cannot remove. Files are moved to the cache once it finished.
+            with work_dir(files_path, _hash) as run_path:
+                d_input = DiffactoInputFiles(
+                    os.path.join(run_path, "peptides.txt"), os.path.join(run_path, "samples.txt")
+                )
+                cached = (
+                    fetch_file(input_hash, cache_path, "peptides.txt", d_input.peptides)
+                    and fetch_file(input_hash, cache_path, "samples.txt", d_input.samples)
+                )
+                if not cached:
+                    # A file fetched on a partial hit is a link to the cached one,
+                    # compiling must not write through it
+                    for path in d_input:
+                        if os.path.exists(path):
+                            os.remove(path)
+                    d_input = compile_diffacto_data(
+                        pi.control_files, pi.test_files, run_path,
+                        progress=_file_progress(progress, "Compiling Diffacto input: reading files", 0.4),
+                        write_progress=lambda written, fraction: progress(
+                            0.4 + 0.1 * fraction, f"Compiling Diffacto input: {written / 2**20:.1f} MB written"
+                        ),
+                    )
+                progress(0.5, "Running Diffacto")
+                d_out = run_diffacto(d_input, pi.diffacto_path, pi.diffacto_parameters, run_path)
+                data = load_data_diffacto(d_out)
+                store_file(d_out, _hash, cache_path, "diffacto_out.txt")
+                if not cached:
+                    store_file(d_input.peptides, input_hash, cache_path, "peptides.txt")
+                    store_file(d_input.samples, input_hash, cache_path, "samples.txt")
+            return data
+
+    elif fmt == "Scavager":
+        _hash = hash_parameters(pi.control_files, pi.test_files, pi.imputation, fmt, **_imputation_parameters(pi))
+
+        def compute():
+            data = check_existing_data(_hash, cache_path)
+            if data is None:
+                tgdf = load_data_scavager(
+                    pi.control_files, pi.test_files,
+                    progress=_file_progress(progress, "Loading files", 0.4)
+                )
+                ogdf = OneGroupDF(tgdf.data, tgdf.K_cols + tgdf.A_cols)
+                progress(0.45, "Imputing missing values")
+                data = impute_missing_values(ogdf, pi.imputation, pi.n_neighbors)
+                tgdf = TwoGroupDF(data, tgdf.K_cols, tgdf.A_cols)
+                progress(0.55, "Calculating fold change and p-values")
+                data = calculate_fold_change_p_value(tgdf)
+                save_data(data, _hash, cache_path)
+            return data
+
+    elif fmt == "MaxQuant":
+        _hash = hash_parameters(
+            pi.single_file, [], pi.imputation, fmt,
+            K_cols=pi.K_cols, A_cols=pi.A_cols, **_imputation_parameters(pi)
+        )
+
+        def compute():
+            data = check_existing_data(_hash, cache_path)
+            if data is None:
+                progress(0.1, "Loading file")
+                ogdf = load_data_maxquant(pi.single_file, pi.K_cols, pi.A_cols)
+                progress(0.45, "Imputing missing values")
+                data = impute_missing_values(ogdf, pi.imputation, pi.n_neighbors)
+                tgdf = TwoGroupDF(data, pi.K_cols, pi.A_cols)
+                progress(0.55, "Calculating fold change and p-values")
+                data = calculate_fold_change_p_value(tgdf)
+                save_data(data, _hash, cache_path)
+            return data
+
+    elif fmt == "DirectMS1Quant":
+        _hash = hash_parameters(pi.single_file, [], "", fmt)
+
+        def compute():
+            return load_data_directms1quant(pi.single_file)
+
+    elif fmt == "Diffacto":
+        _hash = hash_parameters(pi.single_file, [], "", fmt)
+
+        def compute():
+            return load_data_diffacto(pi.single_file)
+
+    else:
+        raise ValueError("File type `{}` is not supported".format(fmt))
+    return _memoized("load", "", _hash, compute)
+
+
+def mtc_stage(loaded: Staged, correction: MTC_method) -> Staged:
+    """Apply multiple testing correction to loaded data."""
+    return _memoized("mtc", loaded.key, correction, lambda: apply_mtc(loaded.value, correction))
+
+
+def thresholds_stage(corrected: Staged, input_format: str) -> Staged:
+    """Calculate thresholds from data distribution."""
+    if input_format == "DirectMS1Quant":
+        return _memoized("thresholds", corrected.key, input_format, lambda: calculate_thresholds_directms1quant(corrected.value))
+    return _memoized("thresholds", corrected.key, input_format, lambda: calculate_thresholds(corrected.value))
+
+
+def resolve_thresholds(
+    corrected: Staged,
+    calculated: Staged,
+    thresholds_set: Thresholds,
+    correction: MTC_method,
+    threshold_calculation: ThC_method,
+) -> Thresholds:
+    """Choose between user-set and calculated thresholds."""
+    if correction == "bonferroni":
+        return mtc_thresholds(thresholds_set, correction, len(corrected.value))
+    return replace_thresholds(thresholds_set, calculated.value, threshold_calculation)
+
+
+def classify_stage(corrected: Staged, thresholds: Thresholds) -> Staged:
+    """Label proteins as UP, DOWN or NOT regulated.
+
+    Corrected data stored under its key can be classified again after a run,
+    without loading input files. `thresholds` are final, i.e. already
+    adjusted for MTC and calculated thresholds.
+    """
+    return _memoized(
+        "classify", corrected.key, tuple(thresholds),
+        lambda: classify_regulation(DFwThresholds(corrected.value, thresholds))
+    )
+
+
+def select_stage(classified: Staged, regulation: REG_types) -> Staged:
+    """Select DE proteins of requested regulation."""
+    return _memoized("select", classified.key, regulation, lambda: select_regulated(classified.value.data, regulation))
+
+
+def plot_stage(classified: Staged, color_scheme: ColorScheme) -> Staged:
+    """Build volcano plot."""
+    return _memoized(
+        "plot", classified.key, sorted(color_scheme.items()),
+        lambda: build_volcano_plot(classified.value, color_scheme)
+    )
+
+
+class PipelineResult(NamedTuple):
+    dwt: DFwThresholds
+    data_de: pd.DataFrame
+    figure: Figure
+    run_id: str
+    # Key of corrected data, see `classify_stage`
+    corrected_id: str
+
+
+def run_pipeline(
+    pi: PipelineInput,
+    thresholds_set: Thresholds,
+    correction: MTC_method,
+    threshold_calculation: ThC_method,
+    regulation: REG_types,
+    color_scheme: ColorScheme,
+    cache_path: str,
+    files_path: str,
+    progress: Progress = _no_progress,
+) -> PipelineResult:
+    """Run all stages, reusing memoized results where inputs did not change."""
+    progress(0, "Loading data")
+    loaded = load_stage(pi, cache_path, files_path, progress)
+    progress(0.7, "Applying multiple testing correction")
+    corrected = mtc_stage(loaded, correction)
+    calculated = thresholds_stage(corrected, "Diffacto" if pi.input_format == "s+d" else pi.input_format)
+    thresholds = resolve_thresholds(corrected, calculated, thresholds_set, correction, threshold_calculation)
+    progress(0.8, "Applying thresholds")
+    classified = classify_stage(corrected, thresholds)
+    selected = select_stage(classified, regulation)
+    progress(0.9, "Building plot")
+    plot = plot_stage(classified, color_scheme)
+    progress(1, "Done")
+    return PipelineResult(classified.value, selected.value, plot.value, selected.key, corrected.key)
@@ -0,0 +1,156 @@
+"""Server-side storage of analysis results
+
+DE tables are stored on disk under a run ID and only the requested page
+is sent to the browser. Callbacks that need the whole table (STRING
+network, saving) load it by run ID.
+
+Run IDs are pipeline stage keys, so the same analysis gets the same ID
+and stored tables never change.
+
+Copyright 2024 Daniil Pomogaev
+SPDX-License-Identifier: Apache-2.0
+"""
+
+import re
+import math
+import operator
+from functools import lru_cache
+
+import pandas as pd
+
+from .cash_or_new import check_existing_data, save_data
+
+# Filter operators of dash DataTable filter queries. Relational operators
+# may have `i` (case-insensitive) or `s` (case-sensitive, default) prefix
+FILTER_OPERATORS = {
+    "=": operator.eq, "eq": operator.eq,
+    "!=": operator.ne, "ne": operator.ne,
+    "<": operator.lt, "lt": operator.lt,
+    "<=": operator.le, "le": operator.le,
+    ">": operator.gt, "gt": operator.gt,
+    ">=": operator.ge, "ge": operator.ge,
+    "contains": lambda column, value: column.str.contains(value, regex=False),
+    "datestartswith": lambda column, value: column.str.startswith(value),
+}
+# Operators that only work on text
+TEXT_OPERATORS = ("contains", "datestartswith")
+
+
+def _is_prime(value) -> bool:
+    if not isinstance(value, (int, float)) or value != int(value) or value < 2:
+        return False
+    return all(int(value) % k for k in range(2, math.isqrt(int(value)) + 1))
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+UNARY_OPERATORS = {
+    "blank": lambda column: column.isna() | (column.astype(str) == ""),
+    "nil": lambda column: column.isna(),
+    "num": lambda column: column.map(_is_number) & column.notna(),
+    "str": lambda column: column.map(lambda value: isinstance(value, str)),
+    "bool": lambda column: column.map(lambda value: isinstance(value, bool)),
+    "object": lambda column: column.map(lambda value: isinstance(value, (dict, list))),
+    "even": lambda column: column.map(lambda value: _is_number(value) and value % 2 == 0),
+    "odd": lambda column: column.map(lambda value: _is_number(value) and value % 2 == 1),
+    "prime": lambda column: column.map(_is_prime),
+}
+FILTER_PART = re.compile(
+    r"\{(?P<column>[^}]+)\}\s*(?:is\s+(?P<unary>[a-z]+)"
+    r"|(?P<case>[is])?(?P<operator>[!<>=]=?|[a-z]+)\s*(?P<value>.*))"
+)
+
+
+def save_result(run_id: str, data: pd.DataFrame, folder: str) -> None:
+    """Store DE table under a run ID."""
+    if check_existing_data(run_id, folder) is None:
+        save_data(data, run_id, folder)
+
+
+@lru_cache(maxsize=8)
+def load_result(run_id: str, folder: str) -> pd.DataFrame:
+    """Load DE table stored under a run ID. The table must not be modified."""
+    data = check_existing_data(run_id, folder)
+    if data is None:
+        raise KeyError(f"No results for run {run_id}")
+    return data
+
+
+def _parse_value(value: str) -> str | float:
+    value = value.strip()
+    if len(value) > 1 and value[0] == value[-1] and value[0] in "\"'`":
+        return value[1:-1]
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def _filter_mask(data: pd.DataFrame, part: str) -> pd.Series:
+    """Rows matching a single `{column} operator value` expression."""
+    match = FILTER_PART.fullmatch(part.strip())
+    if match is None or match["column"] not in data:
+        raise ValueError(f"Unsupported filter: {part.strip()}")
+    column = data[match["column"]]
+    if match["unary"] is not None:
+        if match["unary"] not in UNARY_OPERATORS:
+            raise ValueError(f"Unsupported filter: {part.strip()}")
+        return UNARY_OPERATORS[match["unary"]](column).astype(bool)
+    if match["operator"] not in FILTER_OPERATORS:
+        raise ValueError(f"Unsupported filter: {part.strip()}")
+    value = _parse_value(match["value"])
+    if isinstance(value, str) or match["operator"] in TEXT_OPERATORS:
+        value = str(value)
+        column = column.astype(str)
+        if match["case"] == "i":
+            column, value = column.str.lower(), value.lower()
+    return FILTER_OPERATORS[match["operator"]](column, value).fillna(False).astype(bool)
+
+
+def filter_result(data: pd.DataFrame, filter_query: str) -> pd.DataFrame:
+    """Filter table with a dash DataTable filter query, e.g. `{FC} > 1 && {dbname} icontains alb`.
+
+    Expressions joined with `&&` and `||` are supported, parentheses and
+    negation are not. Raises ValueError on queries that can not be applied.
+    """
+    if not filter_query:
+        return data
+    mask = pd.Series(False, index=data.index)
+    for alternative in filter_query.split(" || "):
+        alternative_mask = pd.Series(True, index=data.index)
+        for part in alternative.split(" && "):
+            alternative_mask &= _filter_mask(data, part)
+        mask |= alternative_mask
+    return data[mask]
+
+
+def query_result(
+    run_id: str,
+    folder: str,
+    page: int,
+    page_size: int,
+    sort_by: list[dict] | None = None,
+    filter_query: str = "",
+    columns: list[str] | None = None,
+) -> tuple[list[dict], int]:
+    """Return one page of filtered and sorted results and number of pages.
+
+    Rows have an `id` with their position in the stored table. If `columns`
+    are given, only those are sent besides `id`; filters and sorting can
+    still use any column.
+    """
+    data = load_result(run_id, folder)
+    data = filter_result(data.assign(id=range(len(data))), filter_query)
+    if sort_by:
+        data = data.sort_values(
+            [s["column_id"] for s in sort_by],
+            ascending=[s["direction"] == "asc" for s in sort_by],
+            kind="stable",
+        )
+    page_count = max(1, -(-len(data) // page_size))
+    page = data.iloc[page * page_size:(page + 1) * page_size]
+    if columns is not None:
+        page = page[[*columns, "id"]]
+    return page.to_dict("records"), page_count
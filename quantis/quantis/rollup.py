@@ -0,0 +1,145 @@
+"""Built-in peptide to protein quantification for s+d
+
+Alternative to running Diffacto as a separate program: the compiled
+peptide matrix is summarized to proteins in memory and the two sample
+groups are compared, without writing any files.
+
+Peptide intensities are log2-transformed and normalized per sample.
+Peptides quantified in fewer than `min_samples` runs are dropped, and a
+peptide missing from more than `impute_threshold` of a group's runs gets
+the lowest intensity of each of those runs. Shared peptides count for all
+their proteins. Every protein is summarized with Tukey's median polish,
+run for all proteins at once with grouped medians, and protein abundances
+of the groups are compared with a two-sample t-test.
+
+The result has the columns of Diffacto output used by `load_data_diffacto`.
+
+Copyright 2024 Daniil Pomogaev
+SPDX-License-Identifier: Apache-2.0
+"""
+
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from .ms1diffacto import DiffactoNormMethod, DiffactoParameters
+
+# Median polish stops after this many sweeps or when no effect changes by more than TOLERANCE (log2 units)
+ITERATIONS = 10
+TOLERANCE = 1e-3
+
+
+def normalize_samples(log_values: np.ndarray, method: DiffactoNormMethod) -> np.ndarray:
+    """Shift log intensities of every sample so that sample centers are equal.
+
+    Centers are taken over peptides quantified in all samples, if there are any.
+    GMM normalization of Diffacto is approximated by median.
+    """
+    if method == 'None':
+        return log_values
+    center = np.nanmean if method == 'average' else np.nanmedian
+    complete = ~np.isnan(log_values).any(axis=1)
+    reference = log_values[complete] if complete.any() else log_values
+    shift = center(reference, axis=0)
+    return log_values - (shift - shift.mean())
+
+
+def impute_groups(log_values: np.ndarray, groups: list[slice], threshold: float) -> np.ndarray:
+    """Fill peptides mostly missing in a group with the lowest value of each sample."""
+    result = log_values.copy()
+    lowest = np.nanmin(log_values, axis=0)
+    for group in groups:
+        values = result[:, group]
+        missing = np.isnan(values)
+        rows = missing.mean(axis=1) > threshold
+        values[rows] = np.where(missing[rows], lowest[group], values[rows])
+    return result
+
+
+def median_polish(log_values: np.ndarray, codes: np.ndarray, n_proteins: int) -> tuple[np.ndarray, np.ndarray]:
+    """Median polish of peptide x sample log intensities within every protein.
+
+    `codes` assign rows to proteins. Returns protein x sample abundances
+    (protein level plus sample effects) and number of peptides of every protein.
+    Samples without any peptides of a protein get NaN.
+    """
+    residuals = log_values.copy()
+    row_effect = np.zeros(len(residuals))
+    col_effect = np.zeros((n_proteins, residuals.shape[1]))
+    for _ in range(ITERATIONS):
+        row_median = np.nanmedian(residuals, axis=1)
+        residuals -= row_median[:, None]
+        row_effect += row_median
+        col_median = pd.DataFrame(residuals).groupby(codes).median().to_numpy()
+        col_median = np.nan_to_num(col_median)
+        residuals -= col_median[codes]
+        col_effect += col_median
+        if max(np.abs(row_median).max(), np.abs(col_median).max()) < TOLERANCE:
+            break
+    level = pd.Series(row_effect).groupby(codes).median().to_numpy()
+    present = pd.DataFrame(~np.isnan(log_values)).groupby(codes).any().to_numpy()
+    abundance = np.where(present, level[:, None] + col_effect, np.nan)
+    return abundance, np.bincount(codes, minlength=n_proteins)
+
+
+def t_test(s1: np.ndarray, s2: np.ndarray) -> np.ndarray:
+    """Two-sample t-test p-values for every row, ignoring missing values.
+
+    Rows without variance or with too few values get 1.
+    """
+    from scipy.stats import t
+
+    n1 = (~np.isnan(s1)).sum(axis=1)
+    n2 = (~np.isnan(s2)).sum(axis=1)
+    dof = n1 + n2 - 2
+    with np.errstate(divide='ignore', invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        var1 = np.where(n1 > 1, np.nanvar(s1, axis=1, ddof=1), 0)
+        var2 = np.where(n2 > 1, np.nanvar(s2, axis=1, ddof=1), 0)
+        pooled = ((n1 - 1) * var1 + (n2 - 1) * var2) / dof
+        stat = (np.nanmean(s2, axis=1) - np.nanmean(s1, axis=1)) / np.sqrt(pooled * (1 / n1 + 1 / n2))
+        pv = 2 * t.sf(np.abs(stat), dof)
+    pv[(dof < 1) | ~(pooled > 0) | np.isnan(pv)] = 1
+    # Underflow would give infinite -log10(p)
+    return np.maximum(pv, np.finfo(float).tiny)
+
+
+def rollup_proteins(
+    peptides: pd.DataFrame,
+    s1_labels: list[str],
+    s2_labels: list[str],
+    parameters: DiffactoParameters,
+) -> pd.DataFrame:
+    """Quantify proteins of the peptide matrix and compare sample groups.
+
+    `peptides` is the matrix built by `compile_peptide_matrix`. Returns table
+    with `Protein`, `Peptides`, `S1`, `S2` and `P(PECA)` columns, like Diffacto
+    output; here `P(PECA)` holds t-test p-values. Proteins not quantified in
+    one of the groups are left out.
+    """
+    labels = s1_labels + s2_labels
+    values = peptides[labels].to_numpy(dtype=float, copy=True)
+    values[~(values > 0)] = np.nan
+    log_values = normalize_samples(np.log2(values), parameters['normalize'])
+
+    quantified = (~np.isnan(log_values)).sum(axis=1)
+    keep = quantified >= max(1, parameters['min_samples'])
+    groups = [slice(0, len(s1_labels)), slice(len(s1_labels), len(labels))]
+    log_values = impute_groups(log_values[keep], groups, parameters['impute_threshold'])
+
+    proteins = peptides['proteins'][keep].reset_index(drop=True).str.split(';').explode()
+    codes, names = pd.factorize(proteins)
+    abundance, counts = median_polish(log_values[proteins.index.to_numpy()], codes, len(names))
+
+    s1, s2 = abundance[:, groups[0]], abundance[:, groups[1]]
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        result = pd.DataFrame({
+            'Protein': names,
+            'Peptides': counts,
+            'S1': np.exp2(np.nanmean(s1, axis=1)),
+            'S2': np.exp2(np.nanmean(s2, axis=1)),
+            'P(PECA)': t_test(s1, s2),
+        })
+    return result.dropna(subset=['S1', 'S2']).reset_index(drop=True)
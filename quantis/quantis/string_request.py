@@ -1,14 +1,66 @@
 """Function to request svg from STRING
 
+Responses are cached on disk, in the `string` folder of the data cache,
+keyed on method, sorted identifiers, species and required score. Cached
+responses expire after QUANTIS_STRING_CACHE_TTL days (7 by default) and
+the folder is kept under QUANTIS_STRING_CACHE_SIZE MB (256 by default).
+With QUANTIS_OFFLINE set, only cached responses are used.
+
+`fetch_string_results` requests the network and enrichment concurrently,
+so each result can be shown as soon as it arrives.
+
 Copyright 2024 Daniil Pomogaev
 SPDX-License-Identifier: Apache-2.0
 """
-import requests as rqt
+import os
+import time
+import json
 import base64
+import hashlib
+import threading
 import pandas as pd
 from io import BytesIO
+from pathlib import Path
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import NamedTuple
+
+from . import http_client
+from .cash_or_new import default_cache_dir, touch_cached_file, evict
+
+STRING_CACHE_SIZE = int(float(os.environ.get("QUANTIS_STRING_CACHE_SIZE", 256)) * 2**20)
+STRING_CACHE_TTL = float(os.environ.get("QUANTIS_STRING_CACHE_TTL", 7)) * 24 * 3600
+
 
-STRING_API_URL= "https://string-db.org/api/"
+def is_offline() -> bool:
+    """Whether STRING responses are served from cache only."""
+    return os.environ.get("QUANTIS_OFFLINE", "") not in ("", "0")
+
+
+def string_cache_dir() -> Path:
+    return default_cache_dir() / "string"
+
+
+def _string_post(request_path: str, params: dict) -> bytes:
+    """POST request to STRING API, answered from the disk cache when possible."""
+    key_params = {**params, "identifiers": sorted(params["identifiers"].split("%0d"))}
+    key = hashlib.md5(
+        json.dumps([request_path, key_params], sort_keys=True).encode(), usedforsecurity=False
+    ).hexdigest()
+    folder = string_cache_dir()
+    cached = folder / f"{key}.{request_path.split('/')[0]}"
+    if cached.exists() and (is_offline() or time.time() - cached.stat().st_mtime <= STRING_CACHE_TTL):
+        touch_cached_file(str(folder), cached.name)
+        return cached.read_bytes()
+    if is_offline():
+        raise LookupError(f"STRING {request_path} response is not cached, and offline mode is on")
+    content = http_client.post("string", request_path, data=params).content
+    folder.mkdir(parents=True, exist_ok=True)
+    tmp_file = cached.with_suffix(f".{os.getpid()}.tmp")
+    tmp_file.write_bytes(content)
+    os.replace(tmp_file, cached)
+    touch_cached_file(str(folder), cached.name)
+    evict(str(folder), STRING_CACHE_SIZE, STRING_CACHE_TTL)
+    return content
 
 def get_string_svg(proteins, species, required_score=None):
     """Get html-injectable svg of a String plot for given set of proteins
@@ -24,7 +76,7 @@ def get_string_svg(proteins, species, required_score=None):
     #     return ""
     output_format = "svg"
     method = "network"
-    request_url = STRING_API_URL + output_format + "/" + method
+    request_path = output_format + "/" + method
     params = {
     "identifiers" : "%0d".join(proteins), # your protein
     "species": str(species), # species NCBI identifier
@@ -34,46 +86,78 @@ def get_string_svg(proteins, species, required_score=None):
         if irs < 0 or irs > 1000:
             raise ValueError("Required score must be between 0 and 1000")
         params["required_score"] = required_score
-    try:
-        res = rqt.post(request_url, params)
-    except rqt.HTTPError as exception:
-        raise
-    return 'data:image/svg+xml;base64,{}'.format(base64.b64encode(res.content).decode())
+    content = _string_post(request_path, params)
+    return 'data:image/svg+xml;base64,{}'.format(base64.b64encode(content).decode())
 
 
 def get_annotations(proteins, species):
     """Get GO annotations for a set of proteins"""
     output_format = "tsv"
     method = "enrichment"
-    request_url = STRING_API_URL + output_format + "/" + method
+    request_path = output_format + "/" + method
     params = {
     "identifiers" : "%0d".join(proteins), # your protein
     "species": str(species), # species NCBI identifier
     }
-    try:
-        res = rqt.post(request_url, params)
-    except rqt.HTTPError as exception:
-        raise
-    return pd.read_csv(BytesIO(res.content), sep="\t").sort_values("fdr")
+    content = _string_post(request_path, params)
+    return pd.read_csv(BytesIO(content), sep="\t").sort_values("fdr")
 
 
 def get_string_ids(proteins, species) -> list[str]:
     """Get STRING IDs for a set of proteins"""
     output_format = "tsv"
     method = "get_string_ids"
-    request_url = STRING_API_URL + output_format + "/" + method
+    request_path = output_format + "/" + method
     params = {
     "identifiers" : "%0d".join(proteins), # your protein
     "species": str(species), # species NCBI identifier
     "limit": 1
     }
-    try:
-        res = rqt.post(request_url, params)
-    except rqt.HTTPError as exception:
-        raise
-    if "Error" in str(res):
-        raise ValueError("StringDB request resulted in error:\n{}".format(str(res)))
-    df = pd.read_csv(BytesIO(res.content), sep="\t")
+    content = _string_post(request_path, params)
+    if content.startswith(b"Error"):
+        raise ValueError("StringDB request resulted in error:\n{}".format(content.decode(errors="replace")))
+    df = pd.read_csv(BytesIO(content), sep="\t")
     if 'stringId' not in df.columns:
         raise ValueError("stringId column not found. DataFrame columns:\n{}\n\n{}".format(df.columns, df))
-    return df['stringId'].tolist()
\ No newline at end of file
+    return df['stringId'].tolist()
+
+
+class StringResults(NamedTuple):
+    ids: "Future[list[str]]"
+    svg: "Future[str]"
+    annotations: "Future[pd.DataFrame]"
+
+
+_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="string")
+_in_flight: dict[tuple, StringResults] = {}
+_in_flight_lock = threading.Lock()
+
+
+def fetch_string_results(proteins, species, required_score=None) -> StringResults:
+    """Start STRING requests for a set of proteins and return their futures.
+
+    Network SVG and GO enrichment are requested concurrently once STRING IDs
+    are known. Calls for the same set while requests are running share them.
+    """
+    key = (tuple(sorted(proteins)), str(species), required_score)
+    with _in_flight_lock:
+        if key in _in_flight:
+            return _in_flight[key]
+        # IDs are submitted first, so dependent requests never wait on a queued task
+        ids = _pool.submit(get_string_ids, proteins, species)
+        results = StringResults(
+            ids,
+            _pool.submit(lambda: get_string_svg(ids.result(), species, required_score)),
+            _pool.submit(lambda: get_annotations(ids.result(), species)),
+        )
+        _in_flight[key] = results
+
+    def forget(_):
+        if results.svg.done() and results.annotations.done():
+            with _in_flight_lock:
+                if _in_flight.get(key) is results:
+                    del _in_flight[key]
+
+    results.svg.add_done_callback(forget)
+    results.annotations.add_done_callback(forget)
+    return results
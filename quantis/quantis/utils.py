@@ -20,22 +20,24 @@ Others are optional depending on set parameters.
 Functions are separated to make it easier to construct pipelines without
 repeating code and multiple confusing if-else statements.
 
+Heavy dependencies (scipy, statsmodels, plotly.express) are imported by
+the functions that use them, so that importing this module is fast.
+
 Copyright 2024 Daniil Pomogaev
 SPDX-License-Identifier: Apache-2.0
 """
 
+import math
 import pandas as pd
 import numpy as np
-from scipy.stats import ttest_ind, iqr
-from statsmodels.stats.multitest import multipletests
-import plotly.express as px
 from plotly.graph_objects import Figure
 
-from .knn_imputation import knn_impute
-from .df_prep import load_from_lists
+from .knn_imputation import knn_impute_values
+from .df_prep import load_from_lists, FileProgress
 
 from typing import TypedDict, NamedTuple, Literal
 import webbrowser
+import warnings
 
 class DEProtein(TypedDict):
     """DE protein data entry."""
@@ -74,6 +76,12 @@ class DFwThresholds(NamedTuple):
 MTC_method = Literal["bonferroni", "holm", "fdr_bh", "sh", "none"]
 ThC_method = Literal["static", "semi-dynamic", "dynamic", "ms1"]
 REG_types = Literal["UP", "DOWN", "BOTH"]
+REGULATION_LABELS = ["UP", "DOWN", "NOT"]
+
+# Volcano plots with more points are rendered in high-volume mode
+HIGH_VOLUME_POINTS = 20000
+# Number of NOT regulated points kept in high-volume mode
+BACKGROUND_POINTS = 10000
 
 
 # Loading data and normalizing column names
@@ -86,12 +94,12 @@ def load_data_directms1quant(file: str):
     data['FC'] = data['log2FoldChange(S2/S1)']
     return data[['dbname', 'FC', 'p-value', 'FC_pass', 'BH_pass']]
 
-def load_data_scavager(k_files: list[str], a_files: list[str]) -> TwoGroupDF:
+def load_data_scavager(k_files: list[str], a_files: list[str], progress: FileProgress | None = None) -> TwoGroupDF:
     """Load data from Scavager.
     
     All steps are required. Multiple files are expected on input
     """
-    data = load_from_lists(k_files, a_files)
+    data = load_from_lists(k_files, a_files, progress=progress)
     K_cols = [col for col in data.columns if col.startswith("NSAF_K")]
     A_cols = [col for col in data.columns if col.startswith("NSAF_A")]
     return TwoGroupDF(data, K_cols, A_cols)
@@ -108,12 +116,13 @@ def load_data_maxquant(file: str, K_cols: list[str], A_cols: list[str]) -> OneGr
     NSAF_cols = K_cols + A_cols
     return OneGroupDF(data, NSAF_cols)
 
-def load_data_diffacto(file: str) -> pd.DataFrame:
+def load_data_diffacto(file: str | pd.DataFrame) -> pd.DataFrame:
     """Load data from Diffacto.
     
     Similar to DirectMS1Quant, but without already calculated DE proteins.
+    Also takes Diffacto output as a table, e.g. from `rollup.rollup_proteins`.
     """
-    data = pd.read_csv(file, sep='\t')
+    data = pd.read_csv(file, sep='\t') if isinstance(file, str) else file.copy()
     s2 = ('s2' if 's2' in data.columns else 'S2')
     s1 = ('s1' if 's1' in data.columns else 'S1')
     data['dbname'] = data['Protein']
@@ -121,25 +130,61 @@ def load_data_diffacto(file: str) -> pd.DataFrame:
     data['p-value'] = data["P(PECA)"]
     return data[['dbname', 'FC', 'p-value']]
 
-def impute_missing_values(ogdf: OneGroupDF, method: str) -> pd.DataFrame:
+def impute_missing_values(ogdf: OneGroupDF, method: str, n_neighbors: int = 5) -> pd.DataFrame:
     """Impute missing values.
     
     This step is required for Scavager and MaxQuant.
-    Imputation method should be specified.
+    Imputation method should be specified. `n_neighbors` is only used by KNN.
+    Zero values are treated as missing.
     """
-    data = ogdf.data[ogdf.NSAF_cols+["dbname"]].map(lambda v: v if v != 0 else None)
+    values = ogdf.data[ogdf.NSAF_cols].to_numpy(dtype=float, copy=True)
+    values[values == 0] = np.nan
+    missing = np.isnan(values)
+    dbname = ogdf.data["dbname"].to_numpy()
     if method == "Drop":
-        data = data.dropna(subset=ogdf.NSAF_cols).copy(deep=True)
+        keep = ~missing.any(axis=1)
+        data = pd.DataFrame(values[keep], columns=ogdf.NSAF_cols, index=ogdf.data.index[keep])
+        data["dbname"] = dbname[keep]
     elif method == "Min":
-        for col in ogdf.NSAF_cols:
-            min_val = ogdf.data[col].min()
-            data[col] = data[col].fillna(min_val)
+        # Minimum of the original column, as zeros are not replaced there
+        min_vals = ogdf.data[ogdf.NSAF_cols].min().to_numpy(dtype=float)
+        values = np.where(missing, min_vals, values)
+        data = pd.DataFrame(values, columns=ogdf.NSAF_cols, index=ogdf.data.index)
+        data["dbname"] = dbname
     else:
-        data_NSAF = data.set_index('dbname')[ogdf.NSAF_cols]
-        data_NSAF = knn_impute(data_NSAF)
-        data = data_NSAF.reset_index().merge(ogdf.data[['dbname', 'description']], on='dbname', how='left')
+        # Complete rows first, then imputed ones
+        complete = ~missing.any(axis=1)
+        imputed = knn_impute_values(values[~complete], values[complete], n_neighbors)
+        data = pd.DataFrame(np.concatenate([values[complete], imputed]), columns=ogdf.NSAF_cols)
+        data.insert(0, "dbname", np.concatenate([dbname[complete], dbname[~complete]]))
+        if "description" in ogdf.data.columns:
+            data = data.merge(ogdf.data[['dbname', 'description']], on='dbname', how='left')
     return data
 
+def two_group_statistics(k_values: np.ndarray, a_values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Calculate log2 Fold Change and t-test p-value for every row at once.
+
+    `k_values` and `a_values` are (proteins x runs) matrices of control and test groups.
+    Rows where either group holds a single repeated value get p-value of 1.
+    """
+    from scipy.stats import ttest_ind
+
+    k_values = np.asarray(k_values, dtype=float)
+    a_values = np.asarray(a_values, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            fc = np.log2(np.nanmean(a_values, axis=1) / np.nanmean(k_values, axis=1))
+            pv = np.asarray(ttest_ind(a_values, k_values, axis=1).pvalue, dtype=float)  # type: ignore
+    # NaN never equals itself, so groups with missing values are not constant
+    const_k = (k_values == k_values[:, :1]).all(axis=1) | (k_values.shape[1] == 1)
+    const_a = (a_values == a_values[:, :1]).all(axis=1) | (a_values.shape[1] == 1)
+    constant = const_k | const_a
+    pv[constant] = 1
+    if (pv == 0).any():
+        raise RuntimeError("Zero p-value for proteins at rows {}".format(np.flatnonzero(pv == 0).tolist()))
+    return fc, pv
+
 def calculate_fold_change_p_value(tgdf: TwoGroupDF) -> pd.DataFrame:
     """Calculate Fold Change and p-value.
     
@@ -147,48 +192,50 @@ def calculate_fold_change_p_value(tgdf: TwoGroupDF) -> pd.DataFrame:
     Groups should be specified.
     """
     data = tgdf.data
-    data['FC'] = np.log2(data[tgdf.A_cols].mean(axis=1) / data[tgdf.K_cols].mean(axis=1))
-    def calc_pv(row):
-        vals_k = [row[column] for column in tgdf.K_cols]
-        vals_a = [row[column] for column in tgdf.A_cols]
-        
-        if len(set(vals_a)) == 1 or len(set(vals_k)) == 1:
-            return 1
-        v = ttest_ind(vals_a, vals_k).pvalue  # type: ignore
-        if v == 0:
-            print(vals_k, vals_a)
-            raise RuntimeError
-        return v
-    data['p-value'] = data.apply(calc_pv, axis=1)
+    fc, pv = two_group_statistics(
+        data[tgdf.K_cols].to_numpy(dtype=float),
+        data[tgdf.A_cols].to_numpy(dtype=float),
+    )
+    data['FC'] = fc
+    data['p-value'] = pv
+    return data
+
+def apply_mtc(data: pd.DataFrame, mtc_method: MTC_method) -> pd.DataFrame:
+    """Apply multiple testing correction. Log results.
+
+    Bonferroni correction is applied to the threshold instead, see `mtc_thresholds`.
+    """
+    from statsmodels.stats.multitest import multipletests
+
+    data = data.copy()
+    if mtc_method in ("none", "bonferroni"):
+        data["fdr"] = data["p-value"]
+    else:
+        data["fdr"] = multipletests(data["p-value"], method=mtc_method)[1]
+    data["logFDR"] = -np.log10(data["fdr"])
     return data
 
+def mtc_thresholds(thresholds: Thresholds, mtc_method: MTC_method, n_proteins: int) -> Thresholds:
+    """Adjust p-value threshold for multiple testing correction methods that require it."""
+    if mtc_method == "bonferroni":
+        return Thresholds(thresholds.up_fc, thresholds.down_fc, thresholds.p_value + np.log10(n_proteins))
+    return thresholds
 
 def apply_mtc_and_log(dft: DFwThresholds, mtc_method: MTC_method,) -> DFwThresholds:
     """Apply multiple testing correction. Log results.
 
     This step is required for Scavager and MaxQuant.
     """
-    data = dft.data.copy()
-    if mtc_method == "none":
-        data["fdr"] = data["p-value"]
-        data["logFDR"] = -np.log10(data["fdr"])
-        return DFwThresholds(data, dft.thresholds)
-    if mtc_method == "bonferroni":
-        ths = dft.thresholds
-        new_thresholds = Thresholds(ths.up_fc, ths.down_fc, ths.p_value + np.log10(len(dft.data)))
-        data["fdr"] = data["p-value"]
-        data["logFDR"] = -np.log10(data["fdr"])
-        return DFwThresholds(data, new_thresholds)
-    data = dft.data.copy()
-    data["fdr"] = multipletests(data["p-value"], method=mtc_method)[1]
-    data["logFDR"] = -np.log10(data["fdr"])
-    return DFwThresholds(data, dft.thresholds)
+    data = apply_mtc(dft.data, mtc_method)
+    return DFwThresholds(data, mtc_thresholds(dft.thresholds, mtc_method, len(dft.data)))
 
 def calculate_thresholds(data: pd.DataFrame) -> Thresholds:
     """Calculate threshold for log2FC and -log10p.
     
     This step is required for Scavager and MaxQuant.
     """
+    from scipy.stats import iqr
+
     up_threshold = data['FC'].quantile(0.75) + iqr(data['FC']) * 1.5
     down_threshold = data['FC'].quantile(0.25) - iqr(data['FC']) * 1.5
     p_limit = data['logFDR'].quantile(0.75) + iqr(data['logFDR']) * 1.5
@@ -211,46 +258,119 @@ def calculate_thresholds_directms1quant(data: pd.DataFrame) -> Thresholds:
     p_limit = data[data["BH_pass"]]["logFDR"].min()
     return Thresholds(up_threshold, down_threshold, p_limit)
 
-def apply_thresholds(dwt: DFwThresholds, regulation: REG_types) -> tuple[DFwThresholds, pd.DataFrame]:
-    """Apply thresholds and select DE proteins.
-    
-    This step is required for Scavager and MaxQuant.
+def classify_regulation(dwt: DFwThresholds) -> DFwThresholds:
+    """Label every protein as UP, DOWN or NOT regulated according to thresholds.
+
+    Labels are stored as a categorical column.
     """
-    def up_down_regulated(row, thresholds: Thresholds):
-        if row['FC'] > thresholds.up_fc and row['logFDR'] > thresholds.p_value:
-            return "UP"
-        elif row['FC'] < thresholds.down_fc and row['logFDR'] > thresholds.p_value:
-            return "DOWN"
-        else:
-            return "NOT"
-    
+    thresholds = dwt.thresholds
     data = dwt.data.copy()
-    data['regulation'] = data.apply(up_down_regulated, axis=1, thresholds=dwt.thresholds)
-    dwt = DFwThresholds(data, dwt.thresholds)
+    fc = data['FC'].to_numpy(dtype=float)
+    passed = data['logFDR'].to_numpy(dtype=float) > thresholds.p_value
+    codes = np.select(
+        [passed & (fc > thresholds.up_fc), passed & (fc < thresholds.down_fc)],
+        [0, 1], default=2
+    )
+    data['regulation'] = pd.Categorical.from_codes(codes, categories=REGULATION_LABELS)
+    return DFwThresholds(data, thresholds)
+
+def select_regulated(data: pd.DataFrame, regulation: REG_types) -> pd.DataFrame:
+    """Select DE proteins of requested regulation from classified data."""
     up_data = data[data['regulation'] == "UP"]
     down_data = data[data['regulation'] == "DOWN"]
     if regulation == "UP":
-        return dwt, up_data
+        return up_data
     if regulation == "DOWN":
-        return dwt, down_data
-    return dwt, pd.concat([up_data, down_data], ignore_index=True)
+        return down_data
+    return pd.concat([up_data, down_data], ignore_index=True)
+
+def apply_thresholds(dwt: DFwThresholds, regulation: REG_types) -> tuple[DFwThresholds, pd.DataFrame]:
+    """Apply thresholds and select DE proteins.
+    
+    This step is required for Scavager and MaxQuant.
+    """
+    dwt = classify_regulation(dwt)
+    return dwt, select_regulated(dwt.data, regulation)
 
+def thin_points(x: np.ndarray, y: np.ndarray, budget: int, bins: int = 100, seed: int = 0) -> np.ndarray:
+    """Select at most `budget` points, removing points from the densest regions first.
+
+    Points are binned on a `bins` x `bins` grid and every cell keeps at most the
+    same number of randomly chosen points, so sparse regions are kept intact.
+    Every non-empty cell keeps a point, so the grid is made coarser for small
+    budgets. Returns boolean mask of selected points. Points with NaN
+    coordinates are dropped.
+    """
+    keep = np.zeros(len(x), dtype=bool)
+    idx = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+    if len(idx) <= budget:
+        keep[idx] = True
+        return keep
+    if budget <= 0:
+        return keep
+    bins = max(1, min(bins, math.isqrt(budget)))
+
+    def to_bin(v: np.ndarray) -> np.ndarray:
+        span = (v.max() - v.min()) or 1
+        return np.minimum(((v - v.min()) / span * bins).astype(int), bins - 1)
+
+    cell = to_bin(x[idx]) * bins + to_bin(y[idx])
+    # Largest per-cell limit that fits into the budget
+    counts = np.bincount(cell)
+    low, high = 1, int(counts.max())
+    while low < high:
+        mid = (low + high + 1) // 2
+        if np.minimum(counts, mid).sum() <= budget:
+            low = mid
+        else:
+            high = mid - 1
+    # Rank of every point within its cell, in random order
+    order = np.random.default_rng(seed).permutation(len(idx))
+    order = order[np.argsort(cell[order], kind="stable")]
+    sorted_cells = cell[order]
+    positions = np.arange(len(order))
+    starts = np.maximum.accumulate(np.where(np.r_[True, sorted_cells[1:] != sorted_cells[:-1]], positions, 0))
+    keep[idx[order[positions - starts < low]]] = True
+    return keep
 
 def build_volcano_plot(
     dwt: DFwThresholds,
     color_scheme: ColorScheme,
+    high_volume: int | None = HIGH_VOLUME_POINTS,
 ) -> Figure:
     """Build plotly scatter plot (volcano plot).
     
     This step is required for all paths.
+    With more than `high_volume` points the plot is rendered with WebGL,
+    and NOT regulated points are thinned to BACKGROUND_POINTS. UP and DOWN
+    points are always kept.
+    Custom data of every point is its row number in `dwt.data`, protein
+    names are not sent with the plot.
     """
+    import plotly.express as px
+
     fc_max = abs(dwt.data['FC']).max()
+    data = dwt.data[['FC', 'logFDR', 'regulation']].assign(row=np.arange(len(dwt.data), dtype=np.int32))
+    high = high_volume is not None and len(data) > high_volume
+    if high:
+        background = (data['regulation'] == "NOT").to_numpy()
+        keep = ~background
+        keep[background] = thin_points(
+            data['FC'].to_numpy(dtype=float)[background],
+            data['logFDR'].to_numpy(dtype=float)[background],
+            BACKGROUND_POINTS
+        )
+        data = data.loc[keep]
+        data = data.astype({'FC': np.float32, 'logFDR': np.float32})
     vp = px.scatter(
-        dwt.data, x='FC', y='logFDR', color='regulation',
+        data, x='FC', y='logFDR', color='regulation',
         labels={'regulation': 'Regulation', 'FC': 'Fold Change', 'logFDR': '-log10(FDR)'},
         color_discrete_map=color_scheme, height=750, title='Volcano Plot', opacity=0.8,
-        range_x=[-fc_max*1.1, fc_max*1.1], hover_data={'dbname': True}, custom_data=["dbname"]
+        range_x=[-fc_max*1.1, fc_max*1.1], custom_data=["row"],
+        render_mode=("webgl" if high else "auto"),
     )
+    # One row number per point instead of one-element lists
+    vp.for_each_trace(lambda trace: trace.update(customdata=trace.customdata[:, 0]))
     vp.update_layout(
         title_font_family="Montserrat",
         font_family="Montserrat",